@@ -1,28 +1,74 @@
-import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from functools import partial
 from pathlib import Path
+import secrets
+from typing import Literal
 from uuid import uuid4
 
 import air
 from air.responses import JSONResponse
-from fastapi.responses import StreamingResponse
+from air.responses import Response
+import anyio
+from fastapi import WebSocket
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.staticfiles import StaticFiles
 
 from eventcloud.auth.routes import router as auth_router
 from eventcloud.auth.session_backend import SessionAuthBackend
+from eventcloud.db import SessionLocal
+from eventcloud.event_broker import AdmissionRejected
 from eventcloud.event_broker import broker
+from eventcloud.event_broker import CLOSE
+from eventcloud.event_broker import format_frame
+from eventcloud.event_broker import MISSED_NOTICE
+from eventcloud.event_broker import MISSED_RECORD
+from eventcloud.event_broker import parse_frame
+from eventcloud.event_broker import relay_frame
+from eventcloud.event_broker import RELAY_VIEW
+from eventcloud.ingest import message_writer
+from eventcloud.metrics import render_prometheus
+from eventcloud.metrics import scrape_allowed
+from eventcloud.metrics import snapshot
+from eventcloud.models import EventMessage
 from eventcloud.r2 import generate_presigned_upload_url
+from eventcloud.ratelimit import client_ip
+from eventcloud.ratelimit import too_many_requests
+from eventcloud.ratelimit import upload_limits
 from eventcloud.routes.events import router as event_router
 from eventcloud.routes.messages import router as message_router
 from eventcloud.settings import settings
+from eventcloud.sse import broker_stream
+from eventcloud.sse import drain_streams_on_sigterm
+from eventcloud.sse import last_event_id_from
 from eventcloud.utils import jinja
+from eventcloud.utils import render_stream_data
+from eventcloud.utils import render_stream_payloads
+from eventcloud.wall_cache import wall_cache
 
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "static"
 
 
-app = air.Air()
+@asynccontextmanager
+async def lifespan(app):
+    # Start listening for frames published by other workers before serving streams,
+    # and keep cached walls current with whatever any worker publishes
+    if wall_cache.apply_frames not in broker.listeners:
+        broker.listeners.append(wall_cache.apply_frames)
+    await broker.start()
+    drain_streams_on_sigterm(broker)
+    yield
+    # Messages still waiting for their group commit are stored before streams end
+    await message_writer.stop()
+    broker.drain()
+    await broker.stop()
+
+
+app = air.Air(lifespan=lifespan)
 
 app.add_middleware(SessionMiddleware, secret_key=settings.session_secret)
 app.include_router(auth_router)
@@ -60,6 +106,9 @@ def index(request: air.Request):
 
 @app.post("/r2/presign-upload")
 async def get_presigned_upload_url(request: air.Request):
+    retry_after = upload_limits.hit(ip=client_ip(request))
+    if retry_after:
+        return too_many_requests(retry_after)
     form_data = await request.json()
     extension = form_data.get("extension")
     content_type = str(form_data.get("content_type"))
@@ -76,33 +125,173 @@ async def get_presigned_upload_url(request: air.Request):
     )
 
 
+# Stream ids are publish times, and a message can be published a little after a
+# frame that was numbered before it, e.g. while its group commit or coalescing
+# window was open. Replays look back this much further than the client's id; walls
+# drop the cards they already show.
+REPLAY_OVERLAP = timedelta(seconds=30)
+REPLAY_LIMIT = 100
+
+
+def replay_messages_from_db(
+    request: air.Request,
+    code: str,
+    last_event_id: int,
+    view: str,
+    audience: str | None,
+    topic: str | None = None,
+):
+    """Rebuilds message frames for a client that fell behind the broker history.
+
+    At most REPLAY_LIMIT messages are sent, the newest, after a notice saying how
+    many more were missed.
+    """
+    since = datetime.fromtimestamp(last_event_id / 1_000_000, timezone.utc).replace(tzinfo=None)
+    db = SessionLocal()
+    try:
+        messages, missed = EventMessage.get_messages_since(
+            db, code, since - REPLAY_OVERLAP, REPLAY_LIMIT
+        )
+        if topic == "images":
+            messages = [msg for msg in messages if msg.images]
+        elif topic is not None:
+            return []  # pin changes aren't kept, only the messages themselves
+        if view == RELAY_VIEW:
+            frames = [
+                relay_frame(msg.stream_event_id, message_frames(request, msg)) for msg in messages
+            ]
+            if missed:
+                notices = {
+                    "html": format_frame(MISSED_NOTICE.format(missed=missed)).encode(),
+                    "json": format_frame(MISSED_RECORD.format(missed=missed)).encode(),
+                }
+                frames.insert(0, relay_frame(last_event_id, notices))
+            return frames
+        frames = [
+            format_frame(render_stream_data(request, msg, view, audience), msg.stream_event_id)
+            for msg in messages
+        ]
+        if missed:
+            # No id: the client keeps resuming from where it was
+            notice = MISSED_RECORD if view == "json" else MISSED_NOTICE
+            frames.insert(0, format_frame(notice.format(missed=missed)))
+        return frames
+    finally:
+        db.close()
+
+
+def message_frames(request: air.Request, message: EventMessage) -> dict[str, bytes]:
+    return {
+        key: format_frame(data, message.stream_event_id).encode()
+        for key, data in render_stream_payloads(request, message).items()
+    }
+
+
+def stream_audience(request: air.Request, audience: str) -> str:
+    # Pages ask for their own variant; only staff sessions get the staff one
+    if audience == "staff" and not request.session.get("is_staff"):
+        return "public"
+    return audience
+
+
 @app.get("/events/{code}/stream")
-async def event_stream(request: air.Request, code: str):
-    queue = await broker.connect(code)
-
-    async def generator():
-        try:
-            while True:
-                if await request.is_disconnected():
-                    break
-                try:
-                    data = await asyncio.wait_for(queue.get(), timeout=15.0)
-                    yield data
-                except asyncio.TimeoutError:
-                    yield ": ping\n\n"
-        finally:
-            await broker.disconnect(code, queue)
-
-    return StreamingResponse(
-        generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache, no-transform",
-            "Connection": "keep-alive",
-        },
+async def event_stream(
+    request: air.Request,
+    code: str,
+    last_event_id: int | None = None,
+    format: Literal["html", "json"] = "html",
+    audience: Literal["public", "preview", "staff"] = "public",
+    only: Literal["pinned", "images", "staff"] | None = None,
+):
+    # Display screens that show one kind of frame subscribe to just that, see TOPICS
+    audience = stream_audience(request, audience)
+    return await broker_stream(
+        broker,
+        code,
+        last_event_id_from(request, last_event_id),
+        format,
+        audience,
+        fallback=partial(
+            replay_messages_from_db, request, code, view=format, audience=audience, topic=only
+        ),
+        topic=only,
+    )
+
+
+@app.get("/events/{code}/relay")
+async def event_relay_feed(request: air.Request, code: str, last_event_id: int | None = None):
+    """Every rendering of every frame of an event, for stream relays (see eventcloud.relay).
+
+    Needs RELAY_TOKEN as a bearer token; without one configured there is no feed.
+    """
+    token = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not settings.relay_token or not secrets.compare_digest(token, settings.relay_token):
+        return Response(status_code=404)
+    return await broker_stream(
+        broker,
+        code,
+        last_event_id_from(request, last_event_id),
+        RELAY_VIEW,
+        fallback=partial(replay_messages_from_db, request, code, view=RELAY_VIEW, audience=None),
     )
 
 
+async def _until_socket_closes(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+@app.websocket("/events/{code}/ws")
+async def event_socket(
+    websocket: WebSocket, code: str, audience: Literal["public", "preview", "staff"] = "public"
+):
+    """Same broker channel as the SSE stream, for the htmx ws extension.
+
+    Uvicorn negotiates permessage-deflate on WebSockets, so the repeated card
+    markup compresses against the previous messages on the same connection.
+    """
+    await websocket.accept()
+    try:
+        queue = await broker.connect(code, audience=stream_audience(websocket, audience))
+    except AdmissionRejected:
+        await websocket.close(code=1013)  # try again later
+        return
+
+    async def forward_frames():
+        while (frame := await queue.get()) is not CLOSE:
+            event, data = parse_frame(frame)
+            if event == "message" and data:
+                # The ws extension swaps top level elements out of band by id
+                await websocket.send_text(
+                    f'<div id="messages" hx-swap-oob="afterbegin">{data}</div>'
+                )
+            elif event == "pin":
+                await websocket.send_text(data)  # already out of band swaps
+        await websocket.close(code=1013)
+
+    try:
+        async with anyio.create_task_group() as task_group:
+
+            async def run_and_cancel(func):
+                await func()
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(run_and_cancel, forward_frames)
+            await run_and_cancel(partial(_until_socket_closes, websocket))
+    finally:
+        await broker.disconnect(code, queue)
+
+
+@app.get("/metrics")
+async def metrics(request: air.Request, format: str = "prometheus"):
+    # async so the broker is read on the event loop, not from a threadpool worker
+    if not scrape_allowed(request):
+        return Response(status_code=404)
+    if format == "json":
+        return JSONResponse(snapshot(broker))
+    return Response(render_prometheus(broker), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/healthz")
 def healthz():
     return JSONResponse({"ok": True})
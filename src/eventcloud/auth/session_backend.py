@@ -1,4 +1,5 @@
 # eventcloud/auth/session_backend.py
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import sessionmaker
 from starlette.authentication import AuthCredentials
 from starlette.authentication import AuthenticationBackend
@@ -33,6 +34,11 @@ class AuthUser(BaseUser):
         return self._user.email
 
 
+def load_user(user_id):
+    with SessionLocal() as db:
+        return db.get(User, user_id)
+
+
 class SessionAuthBackend(AuthenticationBackend):
     async def authenticate(self, conn: HTTPConnection):
         # SessionMiddleware provides this
@@ -42,9 +48,8 @@ class SessionAuthBackend(AuthenticationBackend):
             # no auth; Starlette will set UnauthenticatedUser()
             return
 
-        # Load the user (sync DB here; fine for most apps)
-        with SessionLocal() as db:
-            user = db.get(User, user_id)
+        # Load the user on the threadpool, a sync query here would stall every stream
+        user = await run_in_threadpool(load_user, user_id)
 
         if not user or not user.is_active:
             return  # treat as unauthenticated
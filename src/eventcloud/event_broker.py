@@ -1,38 +1,1159 @@
 import asyncio
+from collections import deque
+import heapq
+import json
+import logging
+import random
+import time
+from uuid import uuid4
 
+from eventcloud.metrics import Counter
+from eventcloud.metrics import FAST_BUCKETS
+from eventcloud.metrics import Histogram
+from eventcloud.metrics import LIFETIME_BUCKETS
+from eventcloud.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BrokerBackend:
+    """Carries published frames to the broker of every worker.
+
+    `publish` is called once per frame by the worker that produced it, with the
+    frame rendered for every view ({view: frame}) but not yet numbered; the backend
+    must then call the `deliver(event_code, frames, event_id)` callback given to
+    `start` on every worker, including the publishing one. The backend numbers the
+    frames: ids of a channel must increase in the order every worker receives them,
+    whichever worker published, since reconnecting clients resume from the id they
+    saw last on any worker. See next_event_id.
+
+    A backend that may have failed to deliver frames, e.g. while its connection was
+    down, says so by calling `lost()`, which the broker sets to its resync.
+    """
+
+    lost = None
+
+    async def start(self, deliver):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event_code, frames):
+        raise NotImplementedError
+
+
+def next_event_id(last_id):
+    """The id after `last_id` in a channel: microseconds since the epoch, so that ids
+    stay comparable with message timestamps, but always above the previous id."""
+    return max(time.time_ns() // 1000, last_id + 1)
+
+
+class InProcessHub:
+    """Stand-in for a cross-worker transport. Every broker attached to the same hub
+    behaves like a separate worker sharing one LISTEN/NOTIFY channel."""
+
+    def __init__(self):
+        self.receivers = set()
+        self.last_ids = {}  # {event_code: id of the last frame delivered}
+
+    def number(self, event_code):
+        event_id = self.last_ids[event_code] = next_event_id(self.last_ids.get(event_code, 0))
+        return event_id
+
+
+class InProcessBackend(BrokerBackend):
+    def __init__(self, hub=None):
+        self.hub = hub or InProcessHub()
+        self._deliver = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        self.hub.receivers.add(deliver)
+
+    async def stop(self):
+        self.hub.receivers.discard(self._deliver)
+
+    async def publish(self, event_code, frames):
+        # Delivery is synchronous, so numbering here keeps ids in delivery order
+        event_id = self.hub.number(event_code)
+        for deliver in list(self.hub.receivers):
+            deliver(event_code, frames, event_id)
+
+
+class PostgresBackend(BrokerBackend):
+    """Fans frames out across workers through Postgres LISTEN/NOTIFY.
+
+    NOTIFY payloads are capped at 8000 bytes so frames are split into chunks
+    that are stitched back together by every listener.
+
+    Frames are numbered from a row per channel in IDS_TABLE, taken in the same
+    transaction that sends the notifications. The row stays locked until that
+    commit, so publishers of a channel take turns, and Postgres delivers
+    notifications in commit order: every listener sees the ids of a channel
+    increase, whichever worker published. IDS_TABLE is created by the
+    migrations (see models.StreamId).
+    """
+
+    CHUNK_SIZE = 7000  # bytes of frame data per NOTIFY, leaves room for the header
+    RECONNECT_DELAY = 2.0
+    IDS_TABLE = "eventcloud_stream_ids"
+
+    def __init__(self, dsn, channel="eventcloud_broker"):
+        self.dsn = dsn
+        self.channel = channel
+        self._deliver = None
+        self._listener = None
+        self._publisher = None
+        self._publish_lock = asyncio.Lock()
+        self._partials = {}  # {frame_id: [chunk, ...]}
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._publisher:
+            await self._publisher.close()
+            self._publisher = None
+
+    async def publish(self, event_code, frames):
+        import psycopg
+
+        chunks = _split_utf8(json.dumps(frames), self.CHUNK_SIZE)
+        frame_id = uuid4().hex
+        async with self._publish_lock:
+            if self._publisher is None or self._publisher.closed:
+                self._publisher = await psycopg.AsyncConnection.connect(self.dsn, autocommit=True)
+            async with self._publisher.transaction():
+                cursor = await self._publisher.execute(
+                    f"INSERT INTO {self.IDS_TABLE} AS ids (channel, last_id) VALUES (%s, %s) "
+                    "ON CONFLICT (channel) DO UPDATE "
+                    "SET last_id = GREATEST(EXCLUDED.last_id, ids.last_id + 1) "
+                    "RETURNING last_id",
+                    (event_code, next_event_id(0)),
+                )
+                (event_id,) = await cursor.fetchone()
+                for idx, chunk in enumerate(chunks):
+                    payload = f"{frame_id}:{idx}:{len(chunks)}:{event_id}:{event_code}\n{chunk}"
+                    await self._publisher.execute(
+                        "SELECT pg_notify(%s, %s)", (self.channel, payload)
+                    )
+
+    async def _listen(self):
+        import psycopg
+
+        disconnected = False
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    self.dsn, autocommit=True
+                ) as conn:
+                    await conn.execute(f'LISTEN "{self.channel}"')
+                    if disconnected:
+                        # Notifications sent while nobody listened are gone for good
+                        disconnected = False
+                        self._partials.clear()
+                        if self.lost is not None:
+                            self.lost()
+                    async for notify in conn.notifies():
+                        self._receive(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broker listener lost its connection, reconnecting")
+                disconnected = True
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    def _receive(self, payload):
+        header, _, chunk = payload.partition("\n")
+        frame_id, idx, total, event_id, event_code = header.split(":", 4)
+        total, event_id = int(total), int(event_id)
+        if total == 1:
+            self._deliver(event_code, json.loads(chunk), event_id)
+            return
+
+        parts = self._partials.setdefault(frame_id, [None] * total)
+        parts[int(idx)] = chunk
+        if all(p is not None for p in parts):
+            del self._partials[frame_id]
+            self._deliver(event_code, json.loads("".join(parts)), event_id)
+        elif len(self._partials) > 1000:
+            # A publisher died mid-frame; forget the oldest incomplete frame
+            self._partials.pop(next(iter(self._partials)))
+
+
+def _split_utf8(text, limit):
+    """Splits text into pieces of at most `limit` UTF-8 bytes without breaking a character."""
+    data = text.encode()
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(start + limit, len(data))
+        # Step back off UTF-8 continuation bytes so every chunk decodes on its own
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(data[start:end].decode())
+        start = end
+    return chunks or [""]
+
+
+def get_backend(name=None):
+    name = name or settings.broker_backend
+    if name == "memory":
+        return InProcessBackend()
+    if name == "postgres":
+        dsn = settings.database_url.replace("postgresql+psycopg://", "postgresql://", 1)
+        if not dsn.startswith("postgresql://"):
+            raise ValueError("BROKER_BACKEND=postgres requires a Postgres DATABASE_URL")
+        return PostgresBackend(dsn)
+    raise ValueError(f"Unknown broker backend: {name}")
+
+
+# Frames reach subscribers as bytes, encoded once per worker and shared by every stream
+PING = b": ping\n\n"
+# Ends a stream; the browser reconnects after `retry` ms and resumes from Last-Event-ID
+RESYNC = b"retry: 3000\n\n"
+# Soonest a drained stream comes back, to give the replacement instance a moment
+DRAIN_RETRY_FLOOR_MS = 1000
+CLOSE = None
+MISSED_NOTICE = (
+    '<div class="missed-notice text-center text-sm text-gray-600 bg-yellow-50 rounded p-2">'
+    'You missed {missed} messages. <a href="" class="underline">Reload</a></div>'
+)
+MISSED_RECORD = '{{"type": "missed", "missed": {missed}}}'
+# Viewer counts for staff screens, swapped out of band into #viewerCount
+PRESENCE_NOTICE = '<span id="viewerCount" hx-swap-oob="true">{viewers} watching</span>'
+PRESENCE_RECORD = '{{"type": "presence", "viewers": {viewers}}}'
+# Workers exchange their viewer counts through the backend on this channel
+PRESENCE_CHANNEL = "*presence"
+
+# A subscriber's view picks which rendering of each frame it receives. "html" frames
+# carry message card markup, "json" frames one compact JSON record per data line.
+VIEWS = ("html", "json")
+# Who is watching: preview screens mask sender names and staff consoles get pin
+# buttons. Publishers render each audience once and key it as "view:audience";
+# audiences whose rendering is left out share the public one under the bare view.
+AUDIENCES = ("public", "preview", "staff")
+# What a frame is about, for streams that only want some frames: "pinned" for pin
+# changes, "images" for messages with images, "staff" for anything but new messages
+TOPICS = ("pinned", "images", "staff")
+# Carries a frame's topics between workers next to its renderings
+TOPICS_KEY = "*topics"
+# Relays subscribe with this view and get every rendering of a frame at once, as
+# one "frames" event whose data is the {variant: frame} dict in JSON
+RELAY_VIEW = "frames"
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "disconnect", "collapse")
+
+
+def format_frame(html, event_id=None, event="message"):
+    lines = html.splitlines()
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return head + f"event: {event}\n" + "".join(f"data: {ln}\n" for ln in lines) + "\n"
+
+
+def variant_key(view, audience="public"):
+    return view if audience == "public" else f"{view}:{audience}"
+
+
+def pick_frame(frames, view, audience="public"):
+    """The rendering of a frame meant for a subscriber, or None if it has no such view"""
+    return frames.get(variant_key(view, audience)) or frames.get(view)
+
+
+def parse_frame(frame):
+    """Splits a frame built by format_frame back into its event name and data"""
+    if isinstance(frame, bytes):
+        frame = frame.decode()
+    event, data = "message", []
+    for line in frame.splitlines():
+        if line.startswith("event: "):
+            event = line[7:]
+        elif line.startswith("data: "):
+            data.append(line[6:])
+    return event, "\n".join(data)
+
+
+def relay_frame(frame_id, frames, topics=()):
+    """Wraps every rendering of a ring frame into one frame for RELAY_VIEW subscribers"""
+    data = {key: frame.decode() for key, frame in frames.items()}
+    if topics:
+        data[TOPICS_KEY] = ",".join(sorted(topics))
+    return format_frame(json.dumps(data), frame_id, RELAY_VIEW).encode()
+
+
+def _frame_id(frame):
+    if frame and frame.startswith("id: "):
+        return int(frame[4 : frame.index("\n")])
+    return None
+
+
+class FrameRing:
+    """Recent frames of one channel, each stored once as encoded bytes.
+
+    Subscribers read it through their own cursor and reconnecting clients catch up
+    from it. Frames are numbered by position (`seq`); `floor` is the newest event id
+    that may be missing, either because it was evicted or because it was published
+    before this worker started.
+    """
+
+    def __init__(self, floor, size):
+        self.floor = floor
+        self.frames = deque(maxlen=size)  # [(id, {variant: bytes}, topics), ...] oldest first
+        self.first_seq = 0  # seq of frames[0]
+        self.nbytes = 0
+        self.idle_since = time.monotonic()  # None while the channel has subscribers
+
+    @property
+    def next_seq(self):
+        return self.first_seq + len(self.frames)
+
+    def append(self, frame_id, frames, topics=frozenset()):
+        """Adds a frame, returning how many bytes the ring grew by"""
+        evicted = self.evict() if len(self.frames) == self.frames.maxlen else 0
+        size = sum(len(frame) for frame in frames.values())
+        self.frames.append((frame_id, frames, topics))
+        self.nbytes += size
+        return size - evicted
+
+    def evict(self):
+        """Drops the oldest frame, returning its size"""
+        frame_id, frames, _ = self.frames.popleft()
+        self.floor = frame_id
+        self.first_seq += 1
+        size = sum(len(frame) for frame in frames.values())
+        self.nbytes -= size
+        return size
+
+    def at(self, seq):
+        """(id, frames, topics) of the frame at `seq`"""
+        return self.frames[seq - self.first_seq]
+
+    def since(self, last_event_id, view="html", audience="public", topic=None):
+        """Frames newer than `last_event_id`, or None if some may have been lost."""
+        if last_event_id < self.floor:
+            return None
+        newer = [
+            (frame_id, frames, topics)
+            for frame_id, frames, topics in self.frames
+            if frame_id > last_event_id and (topic is None or topic in topics)
+        ]
+        if view == RELAY_VIEW:
+            return [relay_frame(*entry) for entry in newer]
+        picked = (pick_frame(frames, view, audience) for _, frames, _ in newer)
+        return [frame for frame in picked if frame is not None]
+
+
+_EMPTY = object()
+
+
+class Subscriber:
+    """One open stream: a cursor into its channel's ring and a few frames of its own.
+
+    Reads like an asyncio.Queue. Message frames are never copied here, so an idle
+    viewer costs this object plus, while it waits, one future to wake it up.
+    """
+
+    __slots__ = (
+        "broker",
+        "event_code",
+        "view",
+        "audience",
+        "variant",
+        "topic",
+        "cursor",
+        "control",
+        "missed",
+        "closed",
+        "connected_at",
+        "reader",
+        "_waiter",
+    )
+
+    def __init__(self, broker, event_code, cursor, view="html", audience="public", topic=None):
+        self.broker = broker
+        self.event_code = event_code
+        self.view = view
+        self.audience = audience
+        self.variant = variant_key(view, audience)
+        self.topic = topic  # only frames about this, see TOPICS; None for all of them
+        self.cursor = cursor  # seq of the next ring frame to read
+        self.control = []  # pings, notices and CLOSE for this stream only, read first
+        self.missed = 0  # message frames skipped by the "collapse" policy so far
+        self.closed = False
+        self.connected_at = time.monotonic()
+        self.reader = None  # the task that last waited for a frame, see sweep_orphans
+        self._waiter = None
+
+    def qsize(self):
+        return len(self.control) + self.broker._lag(self)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put_nowait(self, frame):
+        self.control.append(frame)
+        self.wake()
+
+    def wants(self, frames, topics):
+        if self.topic is not None and self.topic not in topics:
+            return False
+        return self.view == RELAY_VIEW or self.variant in frames or self.view in frames
+
+    def wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def get_nowait(self):
+        frame = self._read()
+        if frame is _EMPTY:
+            raise asyncio.QueueEmpty
+        return frame
+
+    async def get(self):
+        self.reader = asyncio.current_task()
+        while (frame := self._read()) is _EMPTY:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return frame
+
+    def _read(self):
+        if self.control:
+            return self.control.pop(0)
+        return self.broker._read(self)
+
+
+class AdmissionRejected(Exception):
+    """Raised by connect when this worker shouldn't take another stream right now"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a short sleep.
+
+    Runs only while `active()` is true so idle workers don't keep a timer going.
+    """
+
+    def __init__(self, active, interval=0.25):
+        self.active = active
+        self.interval = interval
+        self.lag = 0.0  # seconds, decays so a single hiccup doesn't shed for long
+        self._task = None
+
+    def ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.active():
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            sample = max(0.0, loop.time() - started - self.interval)
+            self.lag = max(sample, self.lag / 2)
+        self.lag = 0.0
+
+
+class Presence:
+    """Viewers per event across every worker.
+
+    Each worker reports its own counts through the backend every `interval` seconds;
+    a total is the sum of the latest report of every worker heard from recently.
+    """
+
+    EXPIRE_INTERVALS = 3  # reports missed before a worker is assumed gone
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.reports = {}  # {worker_id: (received_at, {event_code: count})}
+        self.broadcast = {}  # {event_code: total last sent to staff streams}
+
+    def receive(self, worker_id, counts):
+        self.reports[worker_id] = (time.monotonic(), counts)
+
+    def totals(self):
+        cutoff = time.monotonic() - self.interval * self.EXPIRE_INTERVALS
+        totals = {}
+        for received_at, counts in list(self.reports.values()):
+            if received_at < cutoff:
+                continue
+            for event_code, count in counts.items():
+                totals[event_code] = totals.get(event_code, 0) + count
+        return totals
+
+    def total(self, event_code):
+        return self.totals().get(event_code, 0)
+
+
+class CoalesceStats:
+    """How a channel's coalescing window is doing, to help tune it"""
 
-class EventBroker:
     def __init__(self):
-        self.channels = {}  # {event_code: set of queues}
+        self.frames = 0  # frames flushed
+        self.fragments = 0  # publish() calls merged into those frames
+        self.total_delay = 0.0  # seconds fragments spent waiting for their flush
+        self.max_delay = 0.0
+
+    @property
+    def avg_delay(self):
+        return self.total_delay / self.fragments if self.fragments else 0.0
+
+    def as_dict(self):
+        return {
+            "frames": self.frames,
+            "fragments": self.fragments,
+            "avg_delay_ms": round(self.avg_delay * 1000, 2),
+            "max_delay_ms": round(self.max_delay * 1000, 2),
+        }
 
-    async def connect(self, event_code):
-        q = asyncio.Queue(maxsize=100)
+
+class PendingBurst:
+    def __init__(self):
+        self.fragments = []  # [(queued_at, {view: data}, topics), ...] oldest first
+        self.flush_task = None
+
+
+class EventBroker:
+    HISTORY_SIZE = 100
+    HEARTBEAT_INTERVAL = 15.0
+    # Seconds a stream may stay connected without ever waiting for a frame
+    ORPHAN_GRACE = 60.0
+    # Seconds a ring is kept after its channel's last subscriber left, so viewers who
+    # come back soon still resume from it; idle rings are looked for at most every
+    # IDLE_RING_SWEEP seconds
+    IDLE_RING_TTL = 300.0
+    IDLE_RING_SWEEP = 30.0
+
+    def __init__(
+        self,
+        backend=None,
+        coalesce_window=None,
+        queue_size=None,
+        slow_consumer_policy=None,
+        channel_budget=None,
+        memory_budget=None,
+        presence_interval=None,
+    ):
+        self.channels = {}  # {event_code: set of Subscribers}
+        self.history = {}  # {event_code: FrameRing}
+        self.listeners = []  # called with (event_code, frames) for every delivered frame
+        self.backend = backend or InProcessBackend()
+
+        # Frames a subscriber may fall behind by, and what happens to one that falls
+        # further, see _handle_slow_consumer
+        self.queue_size = queue_size or settings.broker_queue_size
+        self.slow_consumer_policy = slow_consumer_policy or settings.broker_slow_consumer_policy
+        self._check_policy(self.slow_consumer_policy)
+        self.slow_consumer_policies = {}  # {event_code: policy}, overrides the default
+        # Bytes of frames the rings may hold, per channel and overall
+        self.channel_budget = channel_budget or settings.broker_channel_budget_bytes
+        self.memory_budget = memory_budget or settings.broker_memory_budget_bytes
+        self.queued_bytes = 0
+        self.channel_bytes = {}  # {event_code: bytes}
+        self.dropped_frames = {}  # {event_code: count}
+
+        # Admission control, 0 means unlimited
+        self.max_subscribers = settings.stream_max_per_worker
+        self.max_subscribers_per_event = settings.stream_max_per_event
+        self.shed_lag = settings.stream_shed_lag_ms / 1000
+        self.subscriber_count = 0
+        self.rejected_connections = {}  # {reason: count}
+        self.draining = False
+        self.lag_monitor = LoopLagMonitor(active=lambda: bool(self.channels))
+
+        self.pings_sent = Counter("eventcloud_broker_pings_total", "Keep-alive pings queued")
+        self.orphans_swept = Counter(
+            "eventcloud_stream_orphans_swept_total",
+            "Subscribers disconnected by the sweep because nothing was reading them",
+        )
+        self.fanout_seconds = Histogram(
+            "eventcloud_broker_fanout_seconds",
+            "Time to hand one frame to every subscriber on this worker",
+            FAST_BUCKETS,
+        )
+        self.connection_seconds = Histogram(
+            "eventcloud_stream_connection_seconds", "How long streams stay open", LIFETIME_BUCKETS
+        )
+        self.dispatch_seconds = Histogram(
+            "eventcloud_broker_dispatch_seconds",
+            "Time from a route handing a message off until the broker published it",
+            FAST_BUCKETS,
+        )
+        self.message_seconds = Histogram(
+            "eventcloud_message_publish_seconds",
+            "Time from send_message receiving a message until the broker published it",
+            FAST_BUCKETS,
+        )
+        # Seconds to hold message fragments so a burst goes out as one frame; 0 disables
+        if coalesce_window is None:
+            coalesce_window = settings.broker_coalesce_ms / 1000
+        self.coalesce_window = coalesce_window
+        self.coalesce_windows = {}  # {event_code: seconds}, overrides coalesce_window
+        self.coalesce_stats = {}  # {event_code: CoalesceStats}
+        self._pending = {}  # {event_code: PendingBurst}
+        self._started = False
+        self._start_lock = asyncio.Lock()
+        # Frames of channels without a ring, with ids up to here, may be missing: they
+        # were published before this worker listened or were in a ring dropped since.
+        # Ids are numbered by the backend, see next_event_id
+        self._floor = next_event_id(0)
+        self._rings_swept_at = time.monotonic()
+        self._heartbeat = None
+        # Seconds between viewer count reports and staff updates; 0 disables
+        if presence_interval is None:
+            presence_interval = settings.presence_interval_seconds
+        self.presence = Presence(presence_interval)
+        self.worker_id = uuid4().hex
+        self._presence_task = None
+        # Messages handed off by routes, published in order by one background task
+        self._outbox = asyncio.Queue()
+        self._dispatcher = None
+
+    async def start(self):
+        async with self._start_lock:
+            if not self._started:
+                self.backend.lost = self.resync
+                await self.backend.start(self._deliver)
+                self._started = True
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            await self._outbox.join()
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for event_code in list(self._pending):
+            await self._flush(event_code)
+        async with self._start_lock:
+            if self._heartbeat is not None:
+                self._heartbeat.cancel()
+                self._heartbeat = None
+            if self._presence_task is not None:
+                self._presence_task.cancel()
+                self._presence_task = None
+            self.lag_monitor.stop()
+            if self._started:
+                await self.backend.stop()
+                self._started = False
+            self.draining = False
+
+    async def connect(self, event_code, view="html", audience="public", topic=None):
+        if view not in VIEWS and view != RELAY_VIEW:
+            raise ValueError(f"Unknown stream view: {view}")
+        if audience not in AUDIENCES:
+            raise ValueError(f"Unknown stream audience: {audience}")
+        if topic is not None and topic not in TOPICS:
+            raise ValueError(f"Unknown stream topic: {topic}")
+        self._admit(event_code)
+        if not self._started:
+            await self.start()
+        ring = self._ring(event_code)
+        ring.idle_since = None
+        q = Subscriber(self, event_code, ring.next_seq, view, audience, topic)
         self.channels.setdefault(event_code, set()).add(q)
+        self.subscriber_count += 1
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        if self.presence.interval and (self._presence_task is None or self._presence_task.done()):
+            self._presence_task = asyncio.create_task(self._presence_loop())
+        self.lag_monitor.ensure_running()
         return q
 
+    def _admit(self, event_code):
+        reason = None
+        if self.draining:
+            reason = "draining"
+        elif self.max_subscribers and self.subscriber_count >= self.max_subscribers:
+            reason = "worker_full"
+        elif self.max_subscribers_per_event and (
+            len(self.channels.get(event_code, ())) >= self.max_subscribers_per_event
+        ):
+            reason = "event_full"
+        elif self.shed_lag and self.lag_monitor.lag > self.shed_lag:
+            # The loop is already struggling; don't add streams that every other route pays for
+            reason = "overloaded"
+        if reason:
+            self.rejected_connections[reason] = self.rejected_connections.get(reason, 0) + 1
+            raise AdmissionRejected(reason)
+
     async def disconnect(self, event_code, q):
         qs = self.channels.get(event_code)
-        if not qs:
+        if not qs or q not in qs:
             return
         qs.discard(q)
+        self.subscriber_count -= 1
+        self.connection_seconds.observe(time.monotonic() - q.connected_at)
         if not qs:
             self.channels.pop(event_code, None)
+            ring = self.history.get(event_code)
+            if ring is not None:
+                ring.idle_since = time.monotonic()
+
+    def drain(self, window_ms=None):
+        """Ends every open stream ahead of a shutdown, returning how many were ended.
+
+        Each stream gets a random `retry:` within the window so that clients don't
+        all reconnect to the new instance at the same moment; they resume from
+        Last-Event-ID. New streams are refused from here on.
+        """
+        if window_ms is None:
+            window_ms = settings.stream_drain_window_ms
+        self.draining = True
+        return self._end_streams(window_ms)
+
+    def resync(self):
+        """Recovers from frames that never reached this worker, e.g. while the backend
+        was disconnected, returning how many streams were ended.
+
+        Where the gap is isn't known, so clients resuming from before now fall back to
+        the database, and open streams are ended so that they reconnect and do that.
+        """
+        logger.warning("Broker frames may have been lost, resyncing open streams")
+        self._floor = max(self._floor, next_event_id(0))
+        for ring in self.history.values():
+            ring.floor = max(ring.floor, self._floor)
+        return self._end_streams(settings.stream_drain_window_ms)
+
+    def _end_streams(self, window_ms):
+        window_ms = max(window_ms, DRAIN_RETRY_FLOOR_MS)
+        drained = 0
+        for event_code, qs in list(self.channels.items()):
+            ring = self._ring(event_code)
+            for q in qs:
+                if q.closed:
+                    continue
+                # Unread frames are left for the replay after the reconnect
+                q.cursor = ring.next_seq
+                q.closed = True
+                retry_ms = random.randint(DRAIN_RETRY_FLOOR_MS, window_ms)
+                q.put_nowait(f"retry: {retry_ms}\n\n".encode())
+                q.put_nowait(CLOSE)
+                drained += 1
+        return drained
+
+    def _ring(self, event_code):
+        ring = self.history.get(event_code)
+        if ring is None:
+            # Deep enough that a subscriber within queue_size frames never loses one
+            size = max(self.HISTORY_SIZE, self.queue_size)
+            ring = self.history[event_code] = FrameRing(self._floor, size)
+        return ring
+
+    def expire_idle_rings(self):
+        """Drops the rings of channels nobody here watched for IDLE_RING_TTL seconds.
+
+        Every worker receives every channel's frames, so without this each would
+        keep a ring for every event ever published to. Returns how many were dropped.
+        """
+        now = self._rings_swept_at = time.monotonic()
+        expired = [
+            event_code
+            for event_code, ring in self.history.items()
+            if ring.idle_since is not None
+            and now - ring.idle_since > self.IDLE_RING_TTL
+            and event_code not in self.channels
+        ]
+        for event_code in expired:
+            ring = self.history.pop(event_code)
+            self._account(event_code, -ring.nbytes)
+            if ring.frames:
+                # Clients resuming this channel here now need the database fallback
+                self._floor = max(self._floor, ring.frames[-1][0])
+        return len(expired)
+
+    def _enforce_memory_budget(self, event_code):
+        """Evicts the oldest frames of any channel until the rings fit memory_budget.
 
-    async def publish(self, event_code, html):
-        lines = html.splitlines()
-        frame = "event: message\n" + "".join(f"data: {ln}\n" for ln in lines) + "\n"
+        Keeps the newest frame of `event_code`, the one being delivered.
+        """
+        oldest = [(ring.frames[0][0], code) for code, ring in self.history.items() if ring.frames]
+        heapq.heapify(oldest)
+        while self.queued_bytes > self.memory_budget and oldest:
+            _, code = heapq.heappop(oldest)
+            ring = self.history[code]
+            if code == event_code and len(ring.frames) == 1:
+                continue
+            # Only subscribers still reading the oldest frames pay for it
+            self._account(code, -ring.evict())
+            if ring.frames:
+                heapq.heappush(oldest, (ring.frames[0][0], code))
 
-        for q in list(self.channels.get(event_code, [])):
+    def _lag(self, q):
+        """Ring frames a subscriber has yet to read, leaving out views it doesn't get"""
+        ring = self.history.get(q.event_code)
+        if ring is None or q.closed:
+            return 0
+        start = max(q.cursor, ring.first_seq)
+        return sum(1 for seq in range(start, ring.next_seq) if q.wants(*ring.at(seq)[1:]))
+
+    def _read(self, q):
+        """Next ring frame for a subscriber, or _EMPTY if it is caught up"""
+        ring = self.history.get(q.event_code)
+        if ring is None or q.closed:
+            return _EMPTY
+        while q.cursor < ring.next_seq:
+            if q.cursor >= ring.first_seq and not q.wants(*ring.at(q.cursor)[1:]):
+                q.cursor += 1  # skipped frames it doesn't want don't make it fall behind
+                continue
+            # Frames it doesn't want don't count, only scanned once it could be behind
+            behind = ring.next_seq - q.cursor > self.queue_size and self._lag(q) > self.queue_size
+            if q.cursor < ring.first_seq or behind:
+                frame = self._handle_slow_consumer(q, ring)
+                if frame is not _EMPTY:
+                    return frame
+                continue
+            frame_id, frames, topics = ring.at(q.cursor)
+            q.cursor += 1
+            if q.view == RELAY_VIEW:
+                return relay_frame(frame_id, frames, topics)
+            frame = frames.get(q.variant) or frames.get(q.view)
+            if frame is not None:
+                return frame
+        return _EMPTY
+
+    def _account(self, event_code, size):
+        self.queued_bytes += size
+        channel_bytes = self.channel_bytes.get(event_code, 0) + size
+        if channel_bytes:
+            self.channel_bytes[event_code] = channel_bytes
+        else:
+            self.channel_bytes.pop(event_code, None)
+
+    @staticmethod
+    def _check_policy(policy):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+    def set_slow_consumer_policy(self, event_code, policy):
+        self._check_policy(policy)
+        self.slow_consumer_policies[event_code] = policy
+
+    async def _heartbeat_loop(self):
+        # One timer for the whole worker instead of a wait_for timeout per connection;
+        # it winds down with the last subscriber and connect starts it again
+        while self.channels:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            await self.sweep_orphans()
+            self.expire_idle_rings()
+            self.ping()
+
+    async def sweep_orphans(self):
+        """Disconnects subscribers whose stream is gone without having disconnected.
+
+        That is one whose reading task has finished, or one that never started
+        reading within ORPHAN_GRACE seconds, e.g. a response that was never sent.
+        Returns how many were swept.
+        """
+        now = time.monotonic()
+        orphans = [
+            q
+            for qs in self.channels.values()
+            for q in qs
+            if (
+                q.reader.done()
+                if q.reader is not None
+                else now - q.connected_at > self.ORPHAN_GRACE
+            )
+        ]
+        for q in orphans:
+            logger.warning("Sweeping an orphaned stream subscriber for %s", q.event_code)
+            await self.disconnect(q.event_code, q)
+        self.orphans_swept.inc(len(orphans))
+        return len(orphans)
+
+    def ping(self):
+        """Keeps idle streams alive through proxies that close quiet connections"""
+        pinged = 0
+        for qs in self.channels.values():
+            for q in qs:
+                if q.empty():
+                    q.put_nowait(PING)
+                    pinged += 1
+        self.pings_sent.inc(pinged)
+
+    async def _presence_loop(self):
+        # Joins and leaves only change counts; this loop is the only thing that sends
+        # them, so churn costs nothing beyond one report per worker per interval
+        reported = True
+        while self.channels or reported:
+            await asyncio.sleep(self.presence.interval)
+            try:
+                reported = await self.report_presence()
+            except Exception:
+                logger.exception("Reporting viewer counts failed")
+            self.broadcast_presence()
+
+    async def report_presence(self):
+        """Sends this worker's viewer counts to every worker, returns whether any were open"""
+        counts = {}
+        for event_code, qs in self.channels.items():
+            # A relay feed stands for the relay, not for a viewer
+            viewers = sum(1 for q in qs if q.view != RELAY_VIEW)
+            if viewers:
+                counts[event_code] = viewers
+        report = json.dumps({"worker": self.worker_id, "counts": counts})
+        if not self._started:
+            await self.start()
+        await self.backend.publish(PRESENCE_CHANNEL, {"presence": report})
+        return bool(counts)
+
+    def broadcast_presence(self):
+        """Sends changed viewer totals to the staff streams on this worker"""
+        totals = self.presence.totals()
+        for event_code, qs in self.channels.items():
+            staff = [q for q in qs if q.audience == "staff"]
+            viewers = totals.get(event_code, 0)
+            if not staff or self.presence.broadcast.get(event_code) == viewers:
+                continue
+            self.presence.broadcast[event_code] = viewers
+            frames = {
+                "html": format_frame(PRESENCE_NOTICE.format(viewers=viewers), event="presence"),
+                "json": format_frame(PRESENCE_RECORD.format(viewers=viewers), event="presence"),
+            }
+            encoded = {view: frame.encode() for view, frame in frames.items()}
+            for q in staff:
+                q.put_nowait(encoded[q.view])
+        for event_code in list(self.presence.broadcast):
+            if event_code not in self.channels:
+                del self.presence.broadcast[event_code]
+
+    def replay(self, event_code, last_event_id, view="html", audience="public", topic=None):
+        """Frames published after `last_event_id`, or None if this worker can't tell.
+
+        Call it right after `connect` without awaiting in between, so that every
+        frame lands either in the replay or in the subscriber queue, never both.
+        """
+        ring = self.history.get(event_code)
+        if ring is None:
+            return [] if last_event_id >= self._floor else None
+        return ring.since(last_event_id, view, audience, topic)
+
+    def set_coalesce_window(self, event_code, seconds):
+        """Opts a channel in (or out, with 0) of merging bursts of messages"""
+        self.coalesce_windows[event_code] = seconds
+
+    def dispatch(self, event_code, payloads, event="message", topics=(), received_at=None):
+        """Hands a message to the background dispatcher and returns right away.
+
+        Routes use this so their response time doesn't grow with the number of
+        subscribers; frames keep the order they were dispatched in. `received_at`,
+        the perf_counter() time the message arrived, times its whole way to publish.
+        """
+        self._outbox.put_nowait(
+            (time.perf_counter(), received_at, event_code, payloads, event, topics)
+        )
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def _dispatch_loop(self):
+        while True:
+            queued_at, received_at, event_code, payloads, event, topics = await self._outbox.get()
             try:
-                q.put_nowait(frame)
-            except asyncio.QueueFull:
-                try:
-                    # Drop oldest item to make room
-                    _ = q.get_nowait()
-                    q.put_nowait(frame)
-                except asyncio.QueueFull:
-                    # If it's still full (race condition), just skip
-                    pass
-
-
-broker = EventBroker()
+                await self.publish(event_code, payloads, event, topics)
+                if received_at is not None:
+                    self.message_seconds.observe(time.perf_counter() - received_at)
+            except Exception:
+                logger.exception("Dispatching a frame for %s failed", event_code)
+            finally:
+                self.dispatch_seconds.observe(time.perf_counter() - queued_at)
+                self._outbox.task_done()
+
+    async def publish(self, event_code, payloads, event="message", topics=()):
+        """Sends a message to every stream of the event.
+
+        `payloads` is the html for the "html" view, or {variant_key: data} to also
+        feed other views and audiences; subscribers whose view isn't in it don't get
+        this frame. `topics` (see TOPICS) say what the frame is about for filtered
+        streams; "pinned" and "staff" follow from `event`. Only "message" events are
+        coalesced, others go out right away.
+        """
+        if isinstance(payloads, str):
+            payloads = {"html": payloads}
+        topics = frozenset(topics)
+        if event == "pin":
+            topics |= {"pinned"}
+        if event != "message":
+            topics |= {"staff"}
+
+        if event != "message":
+            # Keep the order: a pin must not overtake the message it is about
+            await self._flush(event_code)
+            await self._publish_frames(event_code, payloads, event, topics)
+            return
+
+        window = self.coalesce_windows.get(event_code, self.coalesce_window)
+        if not window:
+            await self._publish_frames(event_code, payloads, topics=topics)
+            return
+
+        pending = self._pending.get(event_code)
+        if pending is None:
+            pending = self._pending[event_code] = PendingBurst()
+            pending.flush_task = asyncio.create_task(self._flush_after(event_code, window))
+        pending.fragments.append((time.monotonic(), payloads, topics))
+
+    async def _flush_after(self, event_code, window):
+        await asyncio.sleep(window)
+        await self._flush(event_code)
+
+    async def _flush(self, event_code):
+        pending = self._pending.pop(event_code, None)
+        if not pending:
+            return
+        if pending.flush_task is not asyncio.current_task():
+            # Flushed early, don't let the timer cut the next burst short
+            pending.flush_task.cancel()
+
+        # Fragments about different topics stay in separate frames, so that filtered
+        # streams get exactly their messages
+        runs = []
+        for fragment in pending.fragments:
+            if runs and runs[-1][-1][2] == fragment[2]:
+                runs[-1].append(fragment)
+            else:
+                runs.append([fragment])
+
+        flushed_at = time.monotonic()
+        stats = self.coalesce_stats.setdefault(event_code, CoalesceStats())
+        stats.frames += len(runs)
+        stats.fragments += len(pending.fragments)
+        for queued_at, _, _ in pending.fragments:
+            delay = flushed_at - queued_at
+            stats.total_delay += delay
+            stats.max_delay = max(stats.max_delay, delay)
+
+        # Walls insert each frame with hx-swap="afterbegin", so the newest message
+        # goes first to keep the same order separate frames would have produced.
+        # JSON views carry one record per line, so they merge the same way. A message
+        # without its own rendering for an audience contributes its public one.
+        for run in runs:
+            keys = {key for _, payloads, _ in run for key in payloads}
+            merged = {}
+            for key in keys:
+                view = key.partition(":")[0]
+                parts = [
+                    payloads.get(key) or payloads.get(view) for _, payloads, _ in reversed(run)
+                ]
+                merged[key] = "\n".join(part for part in parts if part is not None)
+            await self._publish_frames(event_code, merged, topics=run[0][2])
+
+    async def _publish_frames(self, event_code, payloads, event="message", topics=frozenset()):
+        # Numbered by the backend on the way, see _deliver
+        frames = {view: format_frame(data, event=event) for view, data in payloads.items()}
+        if topics:
+            frames[TOPICS_KEY] = ",".join(sorted(topics))
+        if not self._started:
+            await self.start()
+        await self.backend.publish(event_code, frames)
+
+    def _deliver(self, event_code, frames, event_id=None):
+        """Adds a frame to the channel ring and wakes the subscribers waiting for it.
+
+        `event_id` is the id the backend numbered the frame with, None for frames
+        that already carry theirs, as relayed ones do.
+        """
+        if event_code == PRESENCE_CHANNEL:
+            report = json.loads(frames["presence"])
+            self.presence.receive(report["worker"], report["counts"])
+            return
+        started = time.perf_counter()
+        topics = frozenset()
+        if TOPICS_KEY in frames:
+            topics = frozenset(frames[TOPICS_KEY].split(","))
+            frames = {key: frame for key, frame in frames.items() if key != TOPICS_KEY}
+        if event_id is None:
+            frame_id = _frame_id(next(iter(frames.values()), None))
+        else:
+            frame_id = event_id
+            frames = {key: f"id: {event_id}\n{frame}" for key, frame in frames.items()}
+        encoded = {key: frame.encode() for key, frame in frames.items()}
+        ring = self._ring(event_code)
+        self._account(event_code, ring.append(frame_id, encoded, topics))
+        while len(ring.frames) > 1 and ring.nbytes > self.channel_budget:
+            # Over budget: only subscribers still reading the oldest frames pay for it
+            self._account(event_code, -ring.evict())
+        if self.queued_bytes > self.memory_budget:
+            self._enforce_memory_budget(event_code)
+        if time.monotonic() - self._rings_swept_at > self.IDLE_RING_SWEEP:
+            self.expire_idle_rings()
+        for listener in self.listeners:
+            try:
+                listener(event_code, frames)
+            except Exception:
+                logger.exception("Broker listener failed on a frame for %s", event_code)
+
+        seq = ring.next_seq - 1
+        for q in self.channels.get(event_code, ()):
+            if q._waiter is None:
+                continue  # busy, it reads this frame or skips it on its own
+            if q.wants(encoded, topics):
+                q.wake()
+            elif q.cursor == seq:
+                # Filtered out; move an idle cursor along so it never looks behind
+                q.cursor += 1
+        self.fanout_seconds.observe(time.perf_counter() - started)
+
+    def _handle_slow_consumer(self, q, ring):
+        """Moves the cursor of a subscriber that fell too far behind, see SLOW_CONSUMER_POLICIES.
+
+        Returns the frame to send instead of the skipped ones, or _EMPTY.
+        """
+        policy = self.slow_consumer_policies.get(q.event_code, self.slow_consumer_policy)
+        if q.view == RELAY_VIEW:
+            policy = "disconnect"  # a relay must not lose frames, it resumes instead
+        frame = _EMPTY
+        if policy == "drop_oldest":
+            cursor = self._newest_wanted(q, ring, self.queue_size)
+        elif policy == "disconnect":
+            # The client reconnects and catches up through Last-Event-ID instead
+            cursor = ring.next_seq
+            q.closed = True
+            q.control.append(CLOSE)
+            frame = RESYNC
+        else:  # collapse: a notice in place of all but the newest frame
+            cursor = self._newest_wanted(q, ring, 1)
+        # Only frames it would have been sent count as dropped; evicted ones can't be
+        # checked anymore and are assumed to
+        dropped = max(0, ring.first_seq - q.cursor) + sum(
+            1 for seq in range(max(q.cursor, ring.first_seq), cursor) if q.wants(*ring.at(seq)[1:])
+        )
+        if policy == "collapse":
+            q.missed += dropped
+            notice = MISSED_RECORD if q.view == "json" else MISSED_NOTICE
+            frame = format_frame(notice.format(missed=q.missed)).encode()
+        q.cursor = cursor
+        self._count_dropped(q.event_code, dropped)
+        return frame
+
+    @staticmethod
+    def _newest_wanted(q, ring, count):
+        """Seq from which on the ring holds the newest `count` frames a subscriber wants"""
+        seq = ring.next_seq
+        while seq > ring.first_seq and count:
+            seq -= 1
+            count -= q.wants(*ring.at(seq)[1:])
+        return seq
+
+    def _count_dropped(self, event_code, count):
+        self.dropped_frames[event_code] = self.dropped_frames.get(event_code, 0) + count
+
+
+broker = EventBroker(backend=get_backend())
@@ -0,0 +1,82 @@
+"""Posting the same message twice stores and shows it once.
+
+The message form carries an idempotency key, new for every message and sent
+again with every retry of it. Keys seen in the last IDEMPOTENCY_TTL_SECONDS
+are kept per worker with the outcome of their post, so a retry is answered
+from memory without touching the database, and one that arrives while the
+original is still being stored waits for it instead of storing a copy.
+
+A retry can also land on another worker. The message uuid is derived from the
+key, so the copy fails on the primary key and is recognised as a duplicate; only
+then is the database asked whether the original is there.
+"""
+
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+from uuid import NAMESPACE_URL
+from uuid import uuid5
+
+from eventcloud.settings import settings
+
+
+def message_uuid(event_code, key):
+    """The uuid every post of a message with this key is stored under"""
+    return str(uuid5(NAMESPACE_URL, f"{settings.host}/message/{event_code}/{key}"))
+
+
+class RecentKeys:
+    """Keys seen in the last `ttl` seconds, at most `max_keys`, oldest dropped first.
+
+    Every key maps to a future that is resolved with True once its post is stored,
+    or False if it failed and a retry should store the message itself.
+    """
+
+    def __init__(self, ttl=None, max_keys=None, clock=time.monotonic):
+        self.ttl = settings.idempotency_ttl_seconds if ttl is None else ttl
+        self.max_keys = max_keys or settings.idempotency_max_keys
+        self.clock = clock
+        self.entries = OrderedDict()  # {key: (expires_at, future)}, oldest first
+
+    def _expire(self, now):
+        # Same ttl for every key, so insertion order is expiry order
+        while self.entries:
+            key, (expires_at, _) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_keys:
+                break
+            del self.entries[key]
+
+    def seen(self, key):
+        """The outcome of an earlier post with this key, or None if there wasn't one"""
+        self._expire(self.clock())
+        entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def add(self, key):
+        """Records a post with this key, resolve the returned future with its outcome"""
+        now = self.clock()
+        stored = asyncio.get_running_loop().create_future()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, stored)
+        self._expire(now)
+        return stored
+
+    @contextmanager
+    def storing(self, key):
+        """Records a post with this key while it is stored. If storing fails the key is
+        forgotten again, and retries waiting on it store the message themselves
+        """
+        stored = self.add(key)
+        try:
+            yield
+        except BaseException:
+            entry = self.entries.get(key)
+            if entry and entry[1] is stored:
+                del self.entries[key]
+            stored.set_result(False)
+            raise
+        stored.set_result(True)
+
+
+recent_posts = RecentKeys()
@@ -0,0 +1,114 @@
+"""Group commit for posted messages.
+
+During live Q&A hundreds of messages a second arrive, and committing each one on
+its own serializes them on the database (on SQLite on its single write lock).
+With INGEST_BATCH_MS set, send_message hands its message to the writer instead:
+messages arriving within that window, up to INGEST_BATCH_SIZE of them, are
+inserted in one transaction, and every request waits for that commit before it
+answers, so nothing is acknowledged that isn't stored. While a batch commits the
+next one gathers, so batches grow with the load on their own.
+
+If a batch fails its messages are retried one by one, so a bad message only fails
+its own request.
+"""
+
+import asyncio
+import logging
+
+from fastapi.concurrency import run_in_threadpool
+
+from eventcloud.db import SessionLocal
+from eventcloud.models import EventMessage
+from eventcloud.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    def __init__(self, sessions=SessionLocal, batch_ms=None, batch_size=None):
+        self.sessions = sessions
+        if batch_ms is None:
+            batch_ms = settings.ingest_batch_ms
+        self.batch_window = batch_ms / 1000
+        self.batch_size = batch_size or settings.ingest_batch_size
+        self.batches = 0
+        self.rows = 0
+        self._queue = None
+        self._task = None
+
+    async def write(self, event_code, text, sender_name, image_keys=(), uuid=None):
+        """Stores a new message with its images and returns it, ready to render"""
+        new = (event_code, text, sender_name, image_keys, uuid)
+        if not self.batch_window:
+            messages = await run_in_threadpool(self._commit, [new])
+            return messages[0]
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        written = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((new, written))
+        return await written
+
+    async def stop(self):
+        """Commits whatever is still queued and stops the writer"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch):
+        try:
+            messages = await run_in_threadpool(self._commit, [new for new, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _, written = batch[0]
+                if not written.done():
+                    written.set_exception(e)
+                return
+            logger.exception("Batch of %d messages failed, storing them one by one", len(batch))
+            for item in batch:
+                await self._write_batch([item])
+            return
+        for (_, written), message in zip(batch, messages):
+            if not written.done():  # the request may have gone away meanwhile
+                written.set_result(message)
+
+    def _commit(self, batch):
+        # Rendered from the objects just written, nothing is read back after the commit
+        with self.sessions(expire_on_commit=False) as db:
+            messages = [EventMessage.new(*new) for new in batch]
+            db.add_all(messages)
+            db.commit()
+        self.batches += 1
+        self.rows += len(messages)
+        return messages
+
+
+message_writer = MessageWriter()
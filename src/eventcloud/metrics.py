@@ -0,0 +1,195 @@
+"""In-process metrics for the broker and event streams.
+
+Recording is a few integer/float updates so it can stay on in the publish and
+stream hot paths; anything that needs a walk over the subscribers is computed
+only when /metrics is scraped.
+"""
+
+import bisect
+import secrets
+
+from eventcloud.settings import settings
+
+# Seconds, for work done inside one request or one publish
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Seconds, for how long a viewer stays connected
+LIFETIME_BUCKETS = (1, 5, 30, 60, 300, 900, 1800, 3600, 7200, 14400)
+# Frames waiting in a subscriber queue
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+    def as_dict(self):
+        return self.value
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def as_dict(self):
+        return {
+            "buckets": dict(zip([str(b) for b in self.buckets + ("+Inf",)], self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+# Requests refused by a rate limit, {"endpoint:scope": count}
+rate_limited = {}
+
+
+def scrape_allowed(request):
+    """Metrics name every live event, so they are for staff sessions and for scrapers
+    sending METRICS_TOKEN as a bearer token"""
+    sent = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if settings.metrics_token and secrets.compare_digest(sent, settings.metrics_token):
+        return True
+    return "session" in request.scope and bool(request.session.get("is_staff"))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labeled(name, help, kind, values, label="event"):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{_escape(key)}"}} {value}')
+    return lines
+
+
+def queue_depths(broker):
+    depths = Histogram(
+        "eventcloud_broker_queue_depth", "Frames waiting per subscriber queue", DEPTH_BUCKETS
+    )
+    for qs in broker.channels.values():
+        for q in qs:
+            depths.observe(q.qsize())
+    return depths
+
+
+def snapshot(broker):
+    """Everything /metrics?format=json returns"""
+    return {
+        "subscribers": {code: len(qs) for code, qs in broker.channels.items()},
+        "subscriber_count": broker.subscriber_count,
+        "viewers": broker.presence.totals(),
+        "queue_depth": queue_depths(broker).as_dict(),
+        "queued_bytes": broker.queued_bytes,
+        "channel_bytes": dict(broker.channel_bytes),
+        "dropped_frames": dict(broker.dropped_frames),
+        "rejected_connections": dict(broker.rejected_connections),
+        "loop_lag_seconds": broker.lag_monitor.lag,
+        "coalesce": {code: stats.as_dict() for code, stats in broker.coalesce_stats.items()},
+        "pings_sent": broker.pings_sent.as_dict(),
+        "orphans_swept": broker.orphans_swept.as_dict(),
+        "fanout_seconds": broker.fanout_seconds.as_dict(),
+        "dispatch_backlog": broker._outbox.qsize(),
+        "dispatch_seconds": broker.dispatch_seconds.as_dict(),
+        "connection_seconds": broker.connection_seconds.as_dict(),
+        "message_seconds": broker.message_seconds.as_dict(),
+        "rate_limited": dict(rate_limited),
+    }
+
+
+def render_prometheus(broker):
+    lines = []
+    lines += _labeled(
+        "eventcloud_broker_subscribers",
+        "Open streams per event on this worker",
+        "gauge",
+        {code: len(qs) for code, qs in broker.channels.items()},
+    )
+    lines += _labeled(
+        "eventcloud_event_viewers",
+        "Open streams per event across all workers, as of the last presence reports",
+        "gauge",
+        broker.presence.totals(),
+    )
+    lines += queue_depths(broker).render()
+    lines += [
+        "# HELP eventcloud_broker_queued_bytes Bytes of frames held in channel rings",
+        "# TYPE eventcloud_broker_queued_bytes gauge",
+        f"eventcloud_broker_queued_bytes {broker.queued_bytes}",
+        "# HELP eventcloud_loop_lag_seconds Recent event loop wake-up lag",
+        "# TYPE eventcloud_loop_lag_seconds gauge",
+        f"eventcloud_loop_lag_seconds {broker.lag_monitor.lag}",
+        "# HELP eventcloud_broker_dispatch_backlog Messages waiting for the background dispatcher",
+        "# TYPE eventcloud_broker_dispatch_backlog gauge",
+        f"eventcloud_broker_dispatch_backlog {broker._outbox.qsize()}",
+    ]
+    lines += _labeled(
+        "eventcloud_broker_dropped_frames_total",
+        "Frames dropped by the slow consumer policy",
+        "counter",
+        broker.dropped_frames,
+    )
+    lines += _labeled(
+        "eventcloud_stream_rejected_total",
+        "Stream connections refused by admission control",
+        "counter",
+        broker.rejected_connections,
+        label="reason",
+    )
+    lines += _labeled(
+        "eventcloud_broker_coalesced_frames_total",
+        "Frames flushed by the coalescing window",
+        "counter",
+        {code: stats.frames for code, stats in broker.coalesce_stats.items()},
+    )
+    lines += _labeled(
+        "eventcloud_broker_coalesced_fragments_total",
+        "Messages merged into coalesced frames",
+        "counter",
+        {code: stats.fragments for code, stats in broker.coalesce_stats.items()},
+    )
+    lines += broker.pings_sent.render()
+    lines += broker.orphans_swept.render()
+    lines += broker.fanout_seconds.render()
+    lines += broker.dispatch_seconds.render()
+    lines += broker.connection_seconds.render()
+    lines += broker.message_seconds.render()
+    lines += _labeled(
+        "eventcloud_rate_limited_total",
+        "Requests refused by a rate limit",
+        "counter",
+        rate_limited,
+        label="limit",
+    )
+    return "\n".join(lines) + "\n"
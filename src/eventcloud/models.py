@@ -3,6 +3,7 @@ from datetime import timezone
 from uuid import uuid4
 
 from sqlalchemy import and_
+from sqlalchemy import BigInteger
 from sqlalchemy import Boolean
 from sqlalchemy import case
 from sqlalchemy import Column
@@ -104,6 +105,52 @@ class EventMessage(Base):
             )
         return messages
 
+    @staticmethod
+    def get_messages_since(db, event_code, since, limit=100):
+        """The newest `limit` messages created after `since`, oldest first, for catching
+        up a stream, and how many older ones after `since` didn't fit
+        """
+        q = db.query(EventMessage).filter(
+            EventMessage.event_id == event_code, EventMessage.created_at > since
+        )
+        messages = (
+            q.options(selectinload(EventMessage.images))
+            .order_by(EventMessage.created_at.desc(), EventMessage.uuid.desc())
+            .limit(limit)
+            .all()
+        )
+        left_out = q.count() - limit if len(messages) == limit else 0
+        return messages[::-1], left_out
+
+    @staticmethod
+    def new(event_code, text, sender_name, image_keys=(), uuid=None):
+        """A new message with its images, keys and timestamps set here instead of by the
+        database so that nothing has to be read back after inserting it
+        """
+        now = datetime.now(timezone.utc)
+        return EventMessage(
+            uuid=uuid or str(uuid4()),
+            event_id=event_code,
+            text=text,
+            sender_name=sender_name,
+            created_at=now,
+            pinned=False,
+            images=[
+                EventMessageImage(
+                    uuid=str(uuid4()), image_key=key, blurred_image_key=None, created_at=now
+                )
+                for key in image_keys
+            ],
+        )
+
+    @property
+    def stream_event_id(self):
+        """Stream frame id matching the time this message was created"""
+        created_at = self.created_at
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return int(created_at.timestamp() * 1_000_000)
+
     @property
     def preview_sender_name(self):
         name = self.sender_name
@@ -119,3 +166,12 @@ class EventMessageImage(Base):
     blurred_image_key = Column(String, nullable=True)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     event_message = relationship("EventMessage", back_populates="images")
+
+
+class StreamId(Base):
+    """Last frame id published on each broker channel, see PostgresBackend."""
+
+    __tablename__ = "eventcloud_stream_ids"
+
+    channel = Column(String, primary_key=True)
+    last_id = Column(BigInteger, nullable=False)
@@ -0,0 +1,143 @@
+"""Token bucket rate limits for posting messages and presigning uploads.
+
+Every scope (an event, a sender, a client IP) gets its own bucket of tokens
+holding up to a minute's allowance and refilled continuously, and a request
+takes one token from each bucket it falls under. A check is a few dict
+operations however many clients there are. Buckets are kept in least recently
+used order and the oldest is dropped once RATE_LIMIT_MAX_KEYS are tracked, so a
+flood of distinct clients can't grow memory; a dropped bucket belonged to the
+client that has been quiet the longest and would mostly have refilled anyway.
+
+Limits are per worker and only used from the event loop, so nothing is locked.
+"""
+
+from collections import OrderedDict
+from ipaddress import ip_address
+from ipaddress import ip_network
+import math
+import time
+
+from fastapi.responses import Response
+
+from eventcloud.metrics import rate_limited
+from eventcloud.settings import settings
+
+
+class TokenBuckets:
+    """Buckets of one scope, refilled at `per_minute` tokens a minute"""
+
+    def __init__(self, per_minute, max_keys):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # {key: (tokens, updated_at)}, least recently used first
+
+    def tokens(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, updated_at = bucket
+        return min(self.capacity, tokens + (now - updated_at) * self.rate)
+
+    def take(self, key, tokens, now):
+        self.buckets[key] = (tokens - 1, now)
+        self.buckets.move_to_end(key)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+
+class RateLimiter:
+    """Rate limits of one endpoint, `limits` is {scope: requests per minute}, 0 disables"""
+
+    def __init__(self, name, limits, max_keys=None, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        max_keys = max_keys or settings.rate_limit_max_keys
+        self.scopes = {
+            scope: TokenBuckets(per_minute, max_keys)
+            for scope, per_minute in limits.items()
+            if per_minute
+        }
+
+    def hit(self, **keys):
+        """Counts a request against the bucket of every scope, e.g. hit(ip=..., event=...).
+
+        Returns 0 if the request may go ahead, otherwise the seconds until it could;
+        a refused request takes no tokens.
+        """
+        now = self.clock()
+        allowed = []
+        for scope, key in keys.items():
+            buckets = self.scopes.get(scope)
+            if buckets is None:
+                continue
+            tokens = buckets.tokens(key, now)
+            if tokens < 1:
+                # Still recently used: evicting it would hand a flooding client a full bucket
+                buckets.buckets.move_to_end(key)
+                label = f"{self.name}:{scope}"
+                rate_limited[label] = rate_limited.get(label, 0) + 1
+                return (1 - tokens) / buckets.rate
+            allowed.append((buckets, key, tokens))
+        for buckets, key, tokens in allowed:
+            buckets.take(key, tokens, now)
+        return 0
+
+
+TRUSTED_PROXIES = [
+    ip_network(network.strip(), strict=False)
+    for network in settings.trusted_proxies.split(",")
+    if network.strip()
+]
+
+
+def _trusted(host):
+    try:
+        address = ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(request):
+    """The address the request came from.
+
+    Behind TRUSTED_PROXIES that is the rightmost X-Forwarded-For hop that isn't one of
+    them: each proxy appends the address it was reached from, anything left of that
+    is whatever the client sent.
+    """
+    peer = request.client.host if request.client else ""
+    if not _trusted(peer):
+        return peer
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",")]
+    hops = [hop for hop in hops if hop]
+    for hop in reversed(hops):
+        if not _trusted(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+def sender_key(request):
+    """Who is posting, by the session the wall page gave them rather than the name they
+    type, which can change with every message; without a session, by their address
+    """
+    return request.session.get("csrf_token") or client_ip(request)
+
+
+def too_many_requests(retry_after):
+    return Response(
+        "Too many requests, try again shortly",
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+
+message_limits = RateLimiter(
+    "message",
+    {
+        "event": settings.rate_limit_event_per_minute,
+        "sender": settings.rate_limit_sender_per_minute,
+        "ip": settings.rate_limit_ip_per_minute,
+    },
+)
+upload_limits = RateLimiter("upload", {"ip": settings.rate_limit_upload_per_minute})
@@ -0,0 +1,290 @@
+"""Stream relay for audiences larger than one app instance can hold.
+
+A relay serves /events/{code}/stream to its own clients from a local broker, fed
+by a single connection per event to the /events/{code}/relay feed of
+RELAY_UPSTREAM_URL. That feed carries the broker frames unchanged, every
+rendering of each one, so relays keep the app's event ids and clients can move
+between relays and the app with Last-Event-ID. A relay serves the same feed,
+so relays can stack, and any number of them can sit behind a load balancer.
+A client resuming from before a relay's own history, e.g. one that just started
+following the event, catches up from the upstream feed.
+
+    RELAY_UPSTREAM_URL=https://app.internal RELAY_TOKEN=... python -m eventcloud.relay
+
+Relays only stream; pages, posting and staff streams stay on the app.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import logging
+import secrets
+import time
+from typing import Literal
+
+import air
+from air.responses import JSONResponse
+from air.responses import Response
+import httpx
+
+from eventcloud.event_broker import _frame_id
+from eventcloud.event_broker import BrokerBackend
+from eventcloud.event_broker import EventBroker
+from eventcloud.event_broker import format_frame
+from eventcloud.event_broker import MISSED_NOTICE
+from eventcloud.event_broker import MISSED_RECORD
+from eventcloud.event_broker import parse_frame
+from eventcloud.event_broker import pick_frame
+from eventcloud.event_broker import RELAY_VIEW
+from eventcloud.event_broker import TOPICS_KEY
+from eventcloud.metrics import render_prometheus
+from eventcloud.metrics import scrape_allowed
+from eventcloud.metrics import snapshot
+from eventcloud.settings import settings
+from eventcloud.sse import broker_stream
+from eventcloud.sse import drain_streams_on_sigterm
+from eventcloud.sse import last_event_id_from
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamBackend(BrokerBackend):
+    """Feeds a relay's broker from the upstream relay feed, one connection per event.
+
+    `follow` opens the feed for an event; it closes again once the event has had no
+    subscribers on this relay for LINGER seconds.
+    """
+
+    LINGER = 30.0
+    RECONNECT_DELAY = 2.0
+    # Catching a client up ends once upstream is this long without a frame, and
+    # gives up after CATCH_UP_TIMEOUT
+    CATCH_UP_QUIET = 0.5
+    CATCH_UP_TIMEOUT = 10.0
+
+    def __init__(self, url, token="", client=None):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.client = client
+        self.has_subscribers = lambda event_code: True
+        self.feeds = {}  # {event_code: asyncio.Task}
+        self._owns_client = client is None
+        self._deliver = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None))
+
+    async def stop(self):
+        feeds = list(self.feeds.values())
+        for feed in feeds:
+            feed.cancel()
+        await asyncio.gather(*feeds, return_exceptions=True)
+        self.feeds.clear()
+        if self._owns_client and self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def publish(self, event_code, frames):
+        raise NotImplementedError("Relays only serve streams, publish on the app")
+
+    def follow(self, event_code):
+        feed = self.feeds.get(event_code)
+        if feed is None or feed.done():
+            self.feeds[event_code] = asyncio.create_task(self._feed(event_code))
+
+    async def _feed(self, event_code):
+        last_event_id = None
+        idle_since = None
+        try:
+            while True:
+                headers = {"Authorization": f"Bearer {self.token}"}
+                if last_event_id is not None:
+                    headers["Last-Event-ID"] = str(last_event_id)
+                delay = self.RECONNECT_DELAY
+                try:
+                    url = f"{self.url}/events/{event_code}/relay"
+                    async with self.client.stream("GET", url, headers=headers) as resp:
+                        resp.raise_for_status()
+                        async for frame in _read_frames(resp):
+                            if frame.startswith("retry: "):
+                                # Upstream is draining; come back when it says to
+                                delay = int(frame[7:]) / 1000
+                                continue
+                            event, data = parse_frame(frame)
+                            if event == RELAY_VIEW:
+                                last_event_id = _frame_id(frame)
+                                self._deliver(event_code, json.loads(data))
+                            # Frames or upstream pings, either way a chance to wind down
+                            if self.has_subscribers(event_code):
+                                idle_since = None
+                            elif idle_since is None:
+                                idle_since = time.monotonic()
+                            elif time.monotonic() - idle_since > self.LINGER:
+                                return
+                except Exception:
+                    logger.exception("Relay feed for %s lost, reconnecting", event_code)
+                if not self.has_subscribers(event_code):
+                    return
+                await asyncio.sleep(delay)
+        finally:
+            if self.feeds.get(event_code) is asyncio.current_task():
+                del self.feeds[event_code]
+
+    async def catch_up(
+        self, event_code, last_event_id, caught_up, view="html", audience="public", topic=None
+    ):
+        """Frames after `last_event_id` for a client resuming from before this relay's
+        history, from a feed of their own upstream.
+
+        Reads until `caught_up(frame_id)` says the relay has the frame itself, or until
+        upstream goes quiet. If upstream can't be read the client is told it missed
+        messages rather than left with a gap.
+        """
+        headers = {"Authorization": f"Bearer {self.token}", "Last-Event-ID": str(last_event_id)}
+        url = f"{self.url}/events/{event_code}/relay"
+        backlog = []
+        try:
+            async with asyncio.timeout(self.CATCH_UP_TIMEOUT):
+                async with self.client.stream("GET", url, headers=headers) as resp:
+                    resp.raise_for_status()
+                    frames = _read_frames(resp)
+                    while True:
+                        try:
+                            frame = await asyncio.wait_for(anext(frames), self.CATCH_UP_QUIET)
+                        except (TimeoutError, StopAsyncIteration):
+                            return backlog
+                        event, data = parse_frame(frame)
+                        if event != RELAY_VIEW:
+                            continue
+                        frame_id = _frame_id(frame)
+                        if frame_id is not None and caught_up(frame_id):
+                            return backlog
+                        renderings = json.loads(data)
+                        topics = renderings.pop(TOPICS_KEY, "").split(",")
+                        if topic is not None and topic not in topics:
+                            continue
+                        if view == RELAY_VIEW:
+                            backlog.append(frame.encode())
+                        elif (picked := pick_frame(renderings, view, audience)) is not None:
+                            backlog.append(picked.encode())
+        except Exception:
+            logger.exception("Catching up a client on %s from upstream failed", event_code)
+        notice = MISSED_RECORD if view == "json" else MISSED_NOTICE
+        missed = "null" if view == "json" else "some"
+        # No id: the client keeps resuming from where it was
+        return [*backlog, format_frame(notice.format(missed=missed)).encode()]
+
+
+async def _read_frames(resp):
+    lines = []
+    async for line in resp.aiter_lines():
+        if line:
+            lines.append(line)
+        elif lines:
+            yield "\n".join(lines) + "\n\n"
+            lines = []
+
+
+def create_relay(upstream_url, token="", client=None):
+    """The relay ASGI app, with its broker as `app.state.broker`"""
+    backend = UpstreamBackend(upstream_url, token, client)
+    # Relays can't report viewers to the app, they only receive from it
+    broker = EventBroker(backend=backend, presence_interval=0)
+    backend.has_subscribers = lambda event_code: bool(broker.channels.get(event_code))
+
+    def catch_up(code, view, audience=None, topic=None):
+        """broker_stream fallback: the frames a client missed, fetched from upstream"""
+
+        async def fallback(last_event_id):
+            # Runs right after connect: the stream gets the frames the ring holds now
+            # from here, later ones from its queue
+            ring = broker.history.get(code)
+            newest = ring.frames[-1][0] if ring and ring.frames else None
+
+            def caught_up(frame_id):
+                if newest is not None:
+                    return frame_id > newest
+                ring = broker.history.get(code)
+                return bool(ring and ring.frames) and frame_id >= ring.frames[0][0]
+
+            return await backend.catch_up(code, last_event_id, caught_up, view, audience, topic)
+
+        return fallback
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await broker.start()
+        drain_streams_on_sigterm(broker)
+        yield
+        broker.drain()
+        await broker.stop()
+
+    app = air.Air(lifespan=lifespan)
+    app.state.broker = broker
+
+    @app.get("/events/{code}/stream")
+    async def event_stream(
+        request: air.Request,
+        code: str,
+        last_event_id: int | None = None,
+        format: Literal["html", "json"] = "html",
+        audience: Literal["public", "preview", "staff"] = "public",
+        only: Literal["pinned", "images", "staff"] | None = None,
+    ):
+        # Relays have no sessions, so staff consoles get the public variant here
+        if audience == "staff":
+            audience = "public"
+        backend.follow(code)
+        return await broker_stream(
+            broker,
+            code,
+            last_event_id_from(request, last_event_id),
+            format,
+            audience,
+            fallback=catch_up(code, format, audience, only),
+            topic=only,
+        )
+
+    @app.get("/events/{code}/relay")
+    async def event_relay_feed(request: air.Request, code: str, last_event_id: int | None = None):
+        sent = request.headers.get("authorization", "").removeprefix("Bearer ")
+        if not token or not secrets.compare_digest(sent, token):
+            return Response(status_code=404)
+        backend.follow(code)
+        return await broker_stream(
+            broker,
+            code,
+            last_event_id_from(request, last_event_id),
+            RELAY_VIEW,
+            fallback=catch_up(code, RELAY_VIEW),
+        )
+
+    @app.get("/metrics")
+    async def metrics(request: air.Request, format: str = "prometheus"):
+        if not scrape_allowed(request):
+            return Response(status_code=404)
+        if format == "json":
+            return JSONResponse(snapshot(broker))
+        return Response(render_prometheus(broker), media_type="text/plain; version=0.0.4")
+
+    @app.get("/healthz")
+    def healthz():
+        return JSONResponse({"ok": True, "feeds": len(backend.feeds)})
+
+    return app
+
+
+if __name__ == "__main__":
+    import os
+
+    import uvicorn
+
+    if not settings.relay_upstream_url:
+        raise SystemExit("Set RELAY_UPSTREAM_URL to the app (or another relay) to relay from")
+    uvicorn.run(
+        create_relay(settings.relay_upstream_url, settings.relay_token),
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8001)),
+    )
@@ -1,6 +1,9 @@
+import asyncio
 from collections.abc import Mapping
+from contextlib import nullcontext
 from datetime import datetime
 from datetime import timezone
+import time
 from uuid import uuid4
 
 import air
@@ -10,7 +13,8 @@ from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
 from fastapi import status
-from sqlalchemy.orm import selectinload
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from eventcloud.auth.deps import current_user
@@ -18,15 +22,23 @@ from eventcloud.auth.models import User
 from eventcloud.db import get_db
 from eventcloud.db import SessionLocal
 from eventcloud.event_broker import broker
+from eventcloud.idempotency import message_uuid
+from eventcloud.idempotency import recent_posts
+from eventcloud.ingest import message_writer
 from eventcloud.models import Event
 from eventcloud.models import EventMessage
-from eventcloud.models import EventMessageImage
+from eventcloud.ratelimit import client_ip
+from eventcloud.ratelimit import message_limits
+from eventcloud.ratelimit import sender_key
+from eventcloud.ratelimit import too_many_requests
 from eventcloud.schemas import EventCreate
 from eventcloud.schemas import EventMessageCreate
 from eventcloud.schemas import EventMessageImageCreate
 from eventcloud.schemas import EventUpdate
 from eventcloud.utils import get_csrf_token
 from eventcloud.utils import jinja
+from eventcloud.utils import render_stream_payloads
+from eventcloud.wall_cache import wall_cache
 
 router = APIRouter(tags=["events"])
 
@@ -62,6 +74,7 @@ def manage_event_form(
             "csrf_token": csrf_token,
             "messages": messages,
             "pinned_messages": pinned_messages,
+            "viewers": broker.presence.total(event.code),
             "user": user,
         },
     )
@@ -76,58 +89,64 @@ async def update_event(request: air.Request, uuid: str, db: Session = Depends(ge
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="CSRF failed")
 
     serialized_data = EventUpdate(**form_data)
-    event = db.query(Event).filter_by(uuid=uuid).first()
-    if not event:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Event not found")
 
-    for field, value in serialized_data.dict(exclude_unset=True).items():
-        setattr(event, field, value)
+    def update():
+        event = db.query(Event).filter_by(uuid=uuid).first()
+        if not event:
+            return None
+        for field, value in serialized_data.dict(exclude_unset=True).items():
+            setattr(event, field, value)
+        db.add(event)
+        db.commit()
+        db.refresh(event)
+        return event
 
-    db.add(event)
-    db.commit()
-    db.refresh(event)
+    # Queries block, run them off the event loop that serves every stream
+    event = await run_in_threadpool(update)
+    if not event:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Event not found")
+    wall_cache.invalidate(event.code)
 
     return RedirectResponse(f"/manage/events/{event.uuid}", status_code=status.HTTP_303_SEE_OTHER)
 
 
 @router.get("/events/{code}/")
 def event_wall(request: air.Request, code: str, db: Session = Depends(get_db)):
-    event = db.query(Event).filter_by(code=code).first()
-    messages = EventMessage.get_messages_for_event(db, event_code=code, pinned=False)
-    pinned_messages = EventMessage.get_messages_for_event(db, event_code=code, pinned=True)
-
-    if not event:
+    wall = wall_cache.get(db, code)
+    if not wall:
         return Response("Event not found", 400)
+    get_csrf_token(request)  # posts from this wall are rate limited by their session
 
     return jinja(
         request,
         "event_wall.html",
         {
-            "event": event,
-            "messages": messages,
-            "pinned_messages": pinned_messages,
-            "event_url": event.get_event_url(),
+            "event": wall.event,
+            "messages": wall.recent,
+            "pinned_messages": wall.pinned,
+            "event_url": wall.event.get_event_url(),
+            "transport": request.query_params.get("transport", "sse"),
+            "stream_format": request.query_params.get("format", "html"),
         },
     )
 
 
 @router.get("/preview/{preview_id}/")
 def preview_event_wall(request: air.Request, preview_id: str, db: Session = Depends(get_db)):
-    event = db.query(Event).filter_by(preview_id=preview_id).first()
-    messages = EventMessage.get_messages_for_event(db, event_code=event.code, pinned=False)
-    pinned_messages = EventMessage.get_messages_for_event(db, event_code=event.code, pinned=True)
-
-    if not event:
+    wall = wall_cache.get_by_preview_id(db, preview_id)
+    if not wall:
         return Response("Event not found", 400)
 
     return jinja(
         request,
         "event_wall.html",
         {
-            "event": event,
-            "messages": messages,
-            "pinned_messages": pinned_messages,
-            "event_url": event.get_event_url(),
+            "event": wall.event,
+            "messages": wall.recent,
+            "pinned_messages": wall.pinned,
+            "event_url": wall.event.get_event_url(),
+            "transport": request.query_params.get("transport", "sse"),
+            "stream_format": request.query_params.get("format", "html"),
         },
     )
 
@@ -138,16 +157,19 @@ async def create_event(request: air.Request, user: User = Depends(current_user))
     data = EventCreate(**create_data)
     created_at = datetime.now(timezone.utc)
 
-    db = SessionLocal()
     event = Event(
         code=data.code,
         title=data.title,
         description=data.description,
         created_at=created_at,
     )
-    db.add(event)
-    db.commit()
-    db.close()
+
+    def save():
+        with SessionLocal() as db:
+            db.add(event)
+            db.commit()
+
+    await run_in_threadpool(save)
     return RedirectResponse(url=f"/events/{data.code}", status_code=302)
 
 
@@ -184,37 +206,59 @@ def get_messages(
     )
 
 
+def message_exists(uuid):
+    with SessionLocal() as db:
+        return db.get(EventMessage, uuid) is not None
+
+
 @router.post("/message/{event_code}/")
 async def send_message(request: air.Request, event_code: str):
+    received_at = time.perf_counter()
     form_data = await request.form()
     message_data = {
         "text": str(form_data.get("text")),
         "sender_name": str(form_data.get("sender_name")),
     }
 
-    image_keys = form_data.getlist("image_keys")
-
     data = EventMessageCreate(**message_data)
-
-    db = SessionLocal()
-    message = EventMessage(event_id=event_code, **data.model_dump())
-    db.add(message)
-    db.commit()
-    db.refresh(message)
-
-    if image_keys and isinstance(image_keys, list):
-        for key in image_keys:
-            data = EventMessageImageCreate(image_key=str(key))
-            image = EventMessageImage(image_key=data.image_key, event_message_id=message.uuid)
-            db.add(image)
-
-    db.commit()
-    db.refresh(message)
-    message = db.query(EventMessage).options(selectinload(EventMessage.images)).get(message.uuid)
-
-    html = jinja(request, "_messages.html", {"messages": [message]}).body.decode()
-    payload = '<span data-autoscroll="1" style="display:none"></span>' + html
-    await broker.publish(event_code, payload)
-
-    db.close()
+    key = str(form_data.get("idempotency_key") or "")[:128]
+    dedupe_key = (event_code, key) if key else None
+    if dedupe_key:
+        earlier = recent_posts.seen(dedupe_key)
+        # A retry of a post this worker stored or is storing, answer it like the original
+        if earlier is not None and await asyncio.shield(earlier):
+            return Response("OK", 200)
+
+    retry_after = message_limits.hit(
+        event=event_code,
+        sender=(event_code, sender_key(request)),
+        ip=client_ip(request),
+    )
+    if retry_after:
+        return too_many_requests(retry_after)
+    image_keys = [
+        EventMessageImageCreate(image_key=str(key)).image_key
+        for key in form_data.getlist("image_keys")
+    ]
+
+    uuid = message_uuid(event_code, key) if key else None
+    with recent_posts.storing(dedupe_key) if dedupe_key else nullcontext():
+        try:
+            message = await message_writer.write(
+                event_code, data.text, data.sender_name, image_keys, uuid
+            )
+        except IntegrityError:
+            # Keys decide the uuid, so this is a retry another worker already stored
+            if not uuid or not await run_in_threadpool(message_exists, uuid):
+                raise
+            return Response("OK", 200)
+
+    payloads = render_stream_payloads(request, message)
+    wall_cache.update_message(message)
+    broker.dispatch(
+        event_code,
+        payloads,
+        topics=("images",) if message.images else (),
+        received_at=received_at,
+    )
     return Response("OK", 200)
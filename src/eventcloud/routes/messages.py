@@ -1,21 +1,31 @@
 import random
+import secrets
 
 import air
 from air.responses import Response
 from fastapi import APIRouter
 from fastapi import Depends
+from fastapi import HTTPException
+from fastapi import status
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy import and_
 from sqlalchemy import case
 from sqlalchemy import or_
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm import Session
 
+from eventcloud.auth.deps import current_user
+from eventcloud.auth.models import User
 from eventcloud.db import get_db
 from eventcloud.db import SessionLocal
+from eventcloud.event_broker import broker
 from eventcloud.models import Event
 from eventcloud.models import EventMessage
 from eventcloud.r2 import get_signed_url_for_key
 from eventcloud.utils import get_blurred_url_for_image_key
 from eventcloud.utils import jinja
+from eventcloud.utils import render_stream_payloads
+from eventcloud.wall_cache import wall_cache
 
 router = APIRouter(tags=["messages"])
 
@@ -98,13 +108,37 @@ def check_older_message(request: air.Request, code: str, before_id: str, limit:
 
 
 @router.post("/message/{uuid}/pin/")
-def toggle_pin(request: air.Request, uuid: str, db: Session = Depends(get_db)):
-    message = db.get(EventMessage, uuid)
-    if message is None:
-        raise ValueError(f"No EventMessage found for uuid={uuid}")
-    message.pinned = not message.pinned
-    db.add(message)
-    db.commit()
+async def toggle_pin(
+    request: air.Request,
+    uuid: str,
+    db: Session = Depends(get_db),
+    user: User = Depends(current_user),
+):
+    if not user.is_staff:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Staff only")
+    # The pin button sends the page's token as a header, see manage_event.html
+    csrf_token = request.headers.get("x-csrf-token", "")
+    session_token = request.session.get("csrf_token")
+    if not session_token or not secrets.compare_digest(csrf_token, session_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="CSRF failed")
+
+    def toggle():
+        message = db.get(EventMessage, uuid)
+        if message is None:
+            raise ValueError(f"No EventMessage found for uuid={uuid}")
+        message.pinned = not message.pinned
+        db.add(message)
+        db.commit()
+        # Reloaded here with its images, so rendering doesn't query from the event loop
+        return db.get(
+            EventMessage, uuid, options=[selectinload(EventMessage.images)], populate_existing=True
+        )
+
+    message = await run_in_threadpool(toggle)
+    wall_cache.update_message(message)
+    # Open walls move the card themselves instead of reloading
+    payloads = render_stream_payloads(request, message, event="pin")
+    broker.dispatch(message.event_id, payloads, event="pin")
 
     return Response("", 200)
 
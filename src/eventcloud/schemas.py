@@ -37,6 +37,28 @@ class EventMessageImageRead(BaseModel):
         from_attributes = True
 
 
+class EventMessageStreamRecord(BaseModel):
+    """Compact form of a message for streams opened with ?format=json"""
+
+    uuid: str
+    text: str | None
+    sender_name: str | None
+    created_at: datetime
+    image_keys: list[str]
+    pinned: bool
+
+    @classmethod
+    def from_message(cls, message, preview_mode=False):
+        return cls(
+            uuid=message.uuid,
+            text=message.text,
+            sender_name=message.preview_sender_name if preview_mode else message.sender_name,
+            created_at=message.created_at,
+            image_keys=[image.image_key for image in message.images],
+            pinned=bool(message.pinned),
+        )
+
+
 class EventMessageCreate(BaseModel):
     text: str
     sender_name: str
@@ -19,6 +19,12 @@ class Settings(BaseSettings):
             return v.replace("postgres://", "postgresql+psycopg://", 1)
         return v
 
+    # Group commit for posted messages: each waits up to this many ms for others to
+    # share its transaction, at most INGEST_BATCH_SIZE per transaction. 0 commits
+    # every message on its own
+    ingest_batch_ms: int = Field(default=0, validation_alias="INGEST_BATCH_MS")
+    ingest_batch_size: int = Field(default=100, validation_alias="INGEST_BATCH_SIZE")
+
     # === R2 / S3 ===
     r2_access_key_id: str = Field(default=..., validation_alias="CLOUDFLARE_R2_ACCESS_KEY_ID")
     r2_secret_access_key: str = Field(
@@ -28,6 +34,77 @@ class Settings(BaseSettings):
     r2_s3_url: str = Field(default=..., validation_alias="CLOUDFLARE_S3_URL")
     session_secret: str = Field(default=..., validation_alias="SESSION_SECRET")
 
+    # === Realtime ===
+    # "memory" keeps fanout inside one process, "postgres" uses LISTEN/NOTIFY so that
+    # every uvicorn worker sees every published frame
+    broker_backend: str = Field(default="memory", validation_alias="BROKER_BACKEND")
+    # Merge messages posted within this many ms into a single stream frame, 0 disables
+    broker_coalesce_ms: int = Field(default=0, validation_alias="BROKER_COALESCE_MS")
+    # Frames a stream may fall behind by before the slow consumer policy kicks in:
+    # "drop_oldest", "disconnect" (client resumes via Last-Event-ID) or "collapse"
+    # (replace the backlog with a "you missed N messages" notice)
+    broker_queue_size: int = Field(default=100, validation_alias="BROKER_QUEUE_SIZE")
+    broker_slow_consumer_policy: str = Field(
+        default="drop_oldest", validation_alias="BROKER_SLOW_CONSUMER_POLICY"
+    )
+    # Bytes of recent frames held in memory for one event / for the whole worker
+    broker_channel_budget_bytes: int = Field(
+        default=16 * 1024 * 1024, validation_alias="BROKER_CHANNEL_BUDGET_BYTES"
+    )
+    broker_memory_budget_bytes: int = Field(
+        default=64 * 1024 * 1024, validation_alias="BROKER_MEMORY_BUDGET_BYTES"
+    )
+    # Stream admission control, 0 disables a limit. Rejected clients get an empty stream
+    # telling them to reconnect in between 1x and 2x STREAM_RETRY_MS
+    stream_max_per_worker: int = Field(default=5000, validation_alias="STREAM_MAX_PER_WORKER")
+    stream_max_per_event: int = Field(default=0, validation_alias="STREAM_MAX_PER_EVENT")
+    stream_shed_lag_ms: int = Field(default=500, validation_alias="STREAM_SHED_LAG_MS")
+    stream_retry_ms: int = Field(default=10000, validation_alias="STREAM_RETRY_MS")
+    # On shutdown open streams are ended with a random retry up to this many ms, so the
+    # reconnects reach the next instance spread out instead of all at once
+    stream_drain_window_ms: int = Field(default=30000, validation_alias="STREAM_DRAIN_WINDOW_MS")
+    # Seconds between viewer count updates on staff screens, 0 disables counting
+    presence_interval_seconds: float = Field(
+        default=5.0, validation_alias="PRESENCE_INTERVAL_SECONDS"
+    )
+    # Shared secret stream relays send to read /events/{code}/relay; empty disables it.
+    # RELAY_UPSTREAM_URL is what a relay (python -m eventcloud.relay) subscribes to,
+    # the app itself or another relay
+    relay_token: str = Field(default="", validation_alias="RELAY_TOKEN")
+    relay_upstream_url: str = Field(default="", validation_alias="RELAY_UPSTREAM_URL")
+    # Bearer token scrapers send to read /metrics; staff sessions can read it without
+    metrics_token: str = Field(default="", validation_alias="METRICS_TOKEN")
+    # === Rate limits ===
+    # Requests per minute, refilled continuously, 0 disables a limit. Posting is limited
+    # per event, per sender (their session) within an event and per client IP (a venue's
+    # wifi can put a whole audience behind one), presigning uploads per client IP
+    rate_limit_event_per_minute: int = Field(
+        default=6000, validation_alias="RATE_LIMIT_EVENT_PER_MINUTE"
+    )
+    rate_limit_sender_per_minute: int = Field(
+        default=20, validation_alias="RATE_LIMIT_SENDER_PER_MINUTE"
+    )
+    rate_limit_ip_per_minute: int = Field(default=300, validation_alias="RATE_LIMIT_IP_PER_MINUTE")
+    rate_limit_upload_per_minute: int = Field(
+        default=120, validation_alias="RATE_LIMIT_UPLOAD_PER_MINUTE"
+    )
+    # Comma separated addresses or networks of the proxies in front of the app, e.g.
+    # "10.0.0.0/8"; only they are believed about X-Forwarded-For
+    trusted_proxies: str = Field(default="", validation_alias="TRUSTED_PROXIES")
+    # Clients tracked per limit and worker, the least recently seen are forgotten first
+    rate_limit_max_keys: int = Field(default=100_000, validation_alias="RATE_LIMIT_MAX_KEYS")
+    # Message idempotency keys remembered per worker, so retried posts aren't stored twice
+    idempotency_ttl_seconds: float = Field(
+        default=600.0, validation_alias="IDEMPOTENCY_TTL_SECONDS"
+    )
+    idempotency_max_keys: int = Field(default=100_000, validation_alias="IDEMPOTENCY_MAX_KEYS")
+    # Walls kept in memory per worker, and how long before one is reloaded from the
+    # database to pick up edits made on other workers
+    wall_cache_events: int = Field(default=256, validation_alias="WALL_CACHE_EVENTS")
+    wall_cache_ttl_seconds: float = Field(default=60.0, validation_alias="WALL_CACHE_TTL_SECONDS")
+    # Strip whitespace and comments from the fragment templates streams carry
+    minify_fragments: bool = Field(default=True, validation_alias="MINIFY_FRAGMENTS")
+
     #
     host: str = Field(default=..., validation_alias="HOST")
 
@@ -0,0 +1,149 @@
+import asyncio
+from functools import partial
+import inspect
+import random
+import signal
+import threading
+
+import anyio
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
+
+from eventcloud.event_broker import AdmissionRejected
+from eventcloud.event_broker import CLOSE
+from eventcloud.settings import settings
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "Connection": "keep-alive",
+}
+
+
+class EventStreamResponse(StreamingResponse):
+    """Server-sent events response that stops as soon as the client goes away.
+
+    Starlette only watches the ASGI receive channel for `http.disconnect` on older
+    ASGI spec versions; here it is always watched and cancels the body iterator, so
+    stream generators can block on their queue instead of polling
+    `request.is_disconnected()`.
+
+    `on_close` is awaited however the response ends, including a failed write or a
+    cancellation before the body iterator ever started, which a `finally` in the
+    generator doesn't cover.
+    """
+
+    media_type = "text/event-stream"
+
+    def __init__(self, content, status_code=200, headers=None, background=None, on_close=None):
+        super().__init__(
+            content,
+            status_code=status_code,
+            headers=SSE_HEADERS | (headers or {}),
+            background=background,
+        )
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            async with anyio.create_task_group() as task_group:
+
+                async def run_and_cancel(func):
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(run_and_cancel, partial(self.stream_response, send))
+                await run_and_cancel(partial(self.listen_for_disconnect, receive))
+        finally:
+            if self.on_close is not None:
+                with anyio.CancelScope(shield=True):
+                    await self.on_close()
+
+        if self.background is not None:
+            await self.background()
+
+
+def last_event_id_from(request, last_event_id=None):
+    # Browsers send Last-Event-ID on their own reconnects, htmx passes it as a query
+    # param when it has to recreate a closed EventSource
+    header_id = request.headers.get("last-event-id", "")
+    if header_id.isdigit():
+        return int(header_id)
+    return last_event_id
+
+
+def stream_unavailable(reason: str):
+    """A stream that only tells the client when to come back, then ends.
+
+    EventSource ignores the body of an error response and htmx reconnects a failed
+    source within a second or two, so a rejection is a 200 whose one frame sets the
+    reconnect delay; the browser waits that long on its own. The retries are spread
+    out so rejected clients don't all come back at once. Other clients can go by
+    the headers.
+    """
+    retry_ms = random.randint(settings.stream_retry_ms, settings.stream_retry_ms * 2)
+    return Response(
+        f"retry: {retry_ms}\n\n",
+        media_type="text/event-stream",
+        headers=SSE_HEADERS | {"Retry-After": str(retry_ms // 1000), "X-Stream-Rejected": reason},
+    )
+
+
+async def broker_stream(
+    broker, code, last_event_id=None, view="html", audience="public", fallback=None, topic=None
+):
+    """Streams a broker channel, starting with the frames the client missed.
+
+    `fallback(last_event_id)` rebuilds missed frames when the broker history doesn't
+    reach back that far; without one the client only gets what comes next. A
+    coroutine function is awaited on the event loop, anything else runs in a thread.
+    """
+    try:
+        queue = await broker.connect(code, view=view, audience=audience, topic=topic)
+    except AdmissionRejected as e:
+        return stream_unavailable(e.reason)
+    backlog = []
+    if last_event_id is not None:
+        backlog = broker.replay(code, last_event_id, view=view, audience=audience, topic=topic)
+        if backlog is None:
+            try:
+                if fallback is None:
+                    backlog = []
+                elif inspect.iscoroutinefunction(fallback):
+                    backlog = await fallback(last_event_id)
+                else:
+                    # Fallbacks read the database, keep that off the event loop
+                    backlog = await run_in_threadpool(fallback, last_event_id)
+            except Exception:
+                await broker.disconnect(code, queue)
+                raise
+
+    async def generator():
+        # EventStreamResponse cancels this generator when the client disconnects and
+        # the broker heartbeat queues the keep-alive pings, so just wait for frames
+        for frame in backlog:
+            yield frame
+        while (frame := await queue.get()) is not CLOSE:
+            yield frame
+
+    return EventStreamResponse(generator(), on_close=partial(broker.disconnect, code, queue))
+
+
+def drain_streams_on_sigterm(broker):
+    """Drains the broker as soon as the server is told to stop.
+
+    Uvicorn waits for open connections to finish before it runs the lifespan
+    shutdown, and event streams never finish on their own, so the drain has to
+    start from the signal. The server's own handler still runs afterwards.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        loop.call_soon_threadsafe(broker.drain)
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
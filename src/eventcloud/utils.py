@@ -1,15 +1,110 @@
 from pathlib import Path
+import re
 import secrets
 
 import air
 from fastapi import Request
+from jinja2.ext import Extension
 
 from eventcloud.db import SessionLocal
+from eventcloud.event_broker import AUDIENCES
+from eventcloud.event_broker import variant_key
+from eventcloud.event_broker import VIEWS
+from eventcloud.models import EventMessage
 from eventcloud.models import EventMessageImage
 from eventcloud.r2 import get_signed_url_for_key
+from eventcloud.schemas import EventMessageStreamRecord
+from eventcloud.settings import settings
 
 BASE_DIR = Path(__file__).resolve().parent
+
+HTML_COMMENT = re.compile(r"<!--.*?-->", re.S)
+BLOCK_TAGS = (
+    "article|aside|blockquote|body|dd|div|dl|dt|figcaption|figure|footer|form|h[1-6]"
+    "|header|hr|li|main|nav|ol|p|section|table|tbody|td|tfoot|th|thead|tr|ul"
+)
+# Whitespace next to a block level tag doesn't render, e.g. "</div>\n  <div" or
+# "%}\n  <div"; between inline tags it is a space, as in "<b>a</b> <i>b</i>"
+AROUND_BLOCK_TAGS = re.compile(
+    rf"\s+(?=</?(?:{BLOCK_TAGS})[\s/>])|(</?(?:{BLOCK_TAGS})(?:\s[^>]*)?/?>)\s+", re.I
+)
+# Jinja statements and comments print nothing, so neither does whitespace between them
+BETWEEN_JINJA_TAGS = re.compile(r"(%}|#})\s+(?={%|{#)")
+LINE_BREAKS = re.compile(r"\s*\n\s*")
+WHITESPACE_MATTERS = re.compile(r"<(script|pre|textarea)\b", re.I)
+
+
+def minify_fragment(source: str) -> str:
+    """Drops comments and the whitespace around block level tags, other runs of
+    whitespace with a line break become a single space"""
+    source = HTML_COMMENT.sub("", source)
+    source = AROUND_BLOCK_TAGS.sub(lambda m: m.group(1) or "", source)
+    source = BETWEEN_JINJA_TAGS.sub(r"\1", source)
+    return LINE_BREAKS.sub(" ", source).strip()
+
+
+class MinifyFragments(Extension):
+    """Minifies the fragment templates (names starting with "_") as they are compiled.
+
+    Fragments are what streams carry to every viewer, once per message, so the
+    indentation that keeps them readable here is sent thousands of times. Templates
+    with script, pre or textarea tags are left alone.
+    """
+
+    def preprocess(self, source, name, filename=None):
+        if name and Path(name).name.startswith("_") and not WHITESPACE_MATTERS.search(source):
+            return minify_fragment(source)
+        return source
+
+
 jinja = air.JinjaRenderer(directory=str(BASE_DIR / "templates"))
+if settings.minify_fragments:
+    jinja.templates.env.add_extension(MinifyFragments)
+
+
+def message_audience(request: Request) -> str:
+    """Which variant of the message cards a page shows, from where it is being viewed"""
+    paths = (request.url.path, request.headers.get("hx-current-url", ""))
+    if request.session.get("is_staff") and any("/manage/events/" in p for p in paths):
+        return "staff"
+    if any("/preview/" in p for p in paths):
+        return "preview"
+    return "public"
+
+
+jinja.templates.env.globals["message_audience"] = message_audience
+
+
+def render_stream_data(
+    request: Request, message: EventMessage, view: str, audience: str, event: str = "message"
+) -> str:
+    if view == "json":
+        record = EventMessageStreamRecord.from_message(message, audience == "preview")
+        return record.model_dump_json()
+    if event == "pin":
+        html = jinja(request, "_message_pin.html", {"msg": message, "audience": audience})
+        return html.body.decode()
+    html = jinja(request, "_messages.html", {"messages": [message], "audience": audience})
+    return '<span data-autoscroll="1" style="display:none"></span>' + html.body.decode()
+
+
+def render_stream_payloads(
+    request: Request, message: EventMessage, event: str = "message"
+) -> dict[str, str]:
+    """Every rendering of a message for broker.publish, one per view and audience.
+
+    `event` is "message" for a new message or "pin" after it was pinned or unpinned.
+    Renderings identical to the public one are left out, subscribers fall back to it.
+    """
+    payloads = {}
+    for view in VIEWS:
+        for audience in AUDIENCES:
+            data = render_stream_data(request, message, view, audience, event)
+            if audience == "public":
+                payloads[view] = data
+            elif data != payloads[view]:
+                payloads[variant_key(view, audience)] = data
+    return payloads
 
 
 def get_csrf_token(request: Request) -> str:
@@ -0,0 +1,179 @@
+"""First page of every busy wall, kept in memory.
+
+A QR code on a projector sends hundreds of people to the same wall at once, so
+the event, its newest messages and its pinned messages are loaded once per worker
+and then kept current in place: send_message and toggle_pin update the worker
+they run on, and every worker picks up new messages and pin changes from the
+broker's JSON frames. Entries still expire after a while so event edits made on
+other workers show up.
+
+Cached rows are detached copies, safe to hand to templates after the session
+that loaded them is gone.
+"""
+
+from collections import OrderedDict
+from datetime import timezone
+import threading
+import time
+
+from eventcloud.event_broker import parse_frame
+from eventcloud.models import Event
+from eventcloud.models import EventMessage
+from eventcloud.models import EventMessageImage
+from eventcloud.schemas import EventMessageStreamRecord
+from eventcloud.settings import settings
+
+
+def _copy_event(event):
+    return Event(**{c.key: getattr(event, c.key) for c in Event.__table__.columns})
+
+
+def _copy_message(message):
+    return EventMessage(
+        uuid=message.uuid,
+        event_id=message.event_id,
+        text=message.text,
+        sender_name=message.sender_name,
+        created_at=message.created_at,
+        pinned=message.pinned,
+        images=[EventMessageImage(image_key=image.image_key) for image in message.images],
+    )
+
+
+def _message_from_record(event_code, record):
+    return EventMessage(
+        uuid=record.uuid,
+        event_id=event_code,
+        text=record.text,
+        sender_name=record.sender_name,
+        created_at=record.created_at,
+        pinned=record.pinned,
+        images=[EventMessageImage(image_key=key) for key in record.image_keys],
+    )
+
+
+def _newest_first(message):
+    created_at = message.created_at
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at, message.uuid
+
+
+class EventWall:
+    def __init__(self, event, recent, pinned):
+        self.event = event
+        self.recent = recent  # unpinned, newest first
+        self.pinned = pinned  # newest first
+        self.loaded_at = time.monotonic()
+
+
+class WallCache:
+    def __init__(self, max_events=256, ttl=60.0, page_size=10):
+        self.max_events = max_events
+        self.ttl = ttl
+        self.page_size = page_size
+        self.walls = OrderedDict()  # event code -> EventWall, least recently used first
+        self.preview_codes = {}
+        self.hits = 0
+        self.misses = 0
+        # Wall routes run in the threadpool while broker deliveries run on the loop
+        self._lock = threading.Lock()
+
+    def get(self, db, code):
+        """The cached wall for an event, loading it on a miss; None if there is no such event"""
+        with self._lock:
+            wall = self._fresh(code)
+        if wall is not None:
+            return wall
+        event = db.query(Event).filter_by(code=code).first()
+        return self._load(db, event) if event else None
+
+    def get_by_preview_id(self, db, preview_id):
+        with self._lock:
+            code = self.preview_codes.get(preview_id)
+            wall = self._fresh(code) if code else None
+        if wall is not None:
+            return wall
+        event = db.query(Event).filter_by(preview_id=preview_id).first()
+        return self._load(db, event) if event else None
+
+    def _fresh(self, code):
+        wall = self.walls.get(code)
+        if wall is None or time.monotonic() - wall.loaded_at > self.ttl:
+            self.misses += 1
+            return None
+        self.walls.move_to_end(code)
+        self.hits += 1
+        return wall
+
+    def _load(self, db, event):
+        recent = EventMessage.get_messages_for_event(db, event.code, limit=self.page_size)
+        pinned = EventMessage.get_messages_for_event(
+            db, event.code, limit=self.page_size, pinned=True
+        )
+        wall = EventWall(
+            _copy_event(event),
+            [_copy_message(m) for m in recent],
+            [_copy_message(m) for m in pinned],
+        )
+        with self._lock:
+            self.walls[event.code] = wall
+            if event.preview_id:
+                self.preview_codes[event.preview_id] = event.code
+            while len(self.walls) > self.max_events:
+                _, evicted = self.walls.popitem(last=False)
+                self.preview_codes.pop(evicted.event.preview_id, None)
+        return wall
+
+    def invalidate(self, event_code):
+        with self._lock:
+            wall = self.walls.pop(event_code, None)
+            if wall is not None:
+                self.preview_codes.pop(wall.event.preview_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.walls.clear()
+            self.preview_codes.clear()
+
+    def update_message(self, message):
+        """Puts a new or re-pinned message where it belongs on its wall, if that wall is cached"""
+        self._place(message.event_id, _copy_message(message))
+
+    def _place(self, event_code, message):
+        # Lists are replaced rather than edited since templates may be iterating them
+        with self._lock:
+            wall = self.walls.get(event_code)
+            if wall is None:
+                return
+            for name in ("recent", "pinned"):
+                messages = getattr(wall, name)
+                cached = next((m for m in messages if m.uuid == message.uuid), None)
+                if cached is None:
+                    continue
+                if cached.pinned == message.pinned:
+                    return  # already there, e.g. send_message then the broker frame
+                if len(messages) == self.page_size:
+                    # Whatever comes next on the page is only in the database
+                    self.walls.pop(event_code)
+                    return
+                setattr(wall, name, [m for m in messages if m is not cached])
+
+            name = "pinned" if message.pinned else "recent"
+            messages = sorted([*getattr(wall, name), message], key=_newest_first, reverse=True)
+            setattr(wall, name, messages[: self.page_size])
+
+    def apply_frames(self, event_code, frames):
+        """Broker delivery hook: applies the new messages and pins of a JSON frame"""
+        if event_code not in self.walls or "json" not in frames:
+            return
+        _, data = parse_frame(frames["json"])
+        for line in data.splitlines():
+            record = EventMessageStreamRecord.model_validate_json(line)
+            self._place(event_code, _message_from_record(event_code, record))
+
+
+wall_cache = WallCache(
+    max_events=settings.wall_cache_events,
+    ttl=settings.wall_cache_ttl_seconds,
+)
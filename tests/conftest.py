@@ -11,12 +11,18 @@ os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
 os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
 os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
 import asyncio
+from base64 import b64encode
+import json
 
 from httpx import ASGITransport
 from httpx import AsyncClient
+import itsdangerous
 import pytest
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
 from eventcloud.app import app
 from eventcloud.auth.deps import current_user
@@ -24,6 +30,8 @@ from eventcloud.db import Base
 from eventcloud.db import get_db
 from eventcloud.models import Event
 from eventcloud.models import EventMessage
+from eventcloud.settings import settings
+from eventcloud.wall_cache import wall_cache
 
 
 # ---- pytest-asyncio event loop (safe for >=0.23) ----
@@ -55,6 +63,30 @@ def session(engine):
     connection.close()
 
 
+# ---- A database of its own, where commits and rollbacks are real ones ----
+@pytest.fixture
+def sessions():
+    engine = create_engine(
+        "sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False}
+    )
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+# ---- A clock that only moves when the test sets `now` ----
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
 # ---- Override get_db to yield our test session ----
 @pytest.fixture(autouse=True)
 def override_get_db(session):
@@ -69,6 +101,32 @@ def override_get_db(session):
     app.dependency_overrides.pop(get_db, None)
 
 
+# ---- Cached walls would outlive the rolled back test data ----
+@pytest.fixture(autouse=True)
+def clear_wall_cache():
+    wall_cache.clear()
+    yield
+    wall_cache.clear()
+
+
+# ---- Queries run on the event loop thread stall every stream on the worker ----
+@pytest.fixture
+def loop_blocking_queries():
+    """Statements executed while an event loop was running in the same thread"""
+    blocking = []
+
+    def record(conn, cursor, statement, *args):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # a threadpool worker
+        blocking.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    yield blocking
+    event.remove(Engine, "before_cursor_execute", record)
+
+
 # ---- Override auth dependency so the route runs ----
 @pytest.fixture(autouse=True)
 def override_current_user():
@@ -90,6 +148,19 @@ async def client():
         yield ac
 
 
+# ---- Signed session cookies, as SessionMiddleware reads them ----
+@pytest.fixture
+def session_cookie():
+    signer = itsdangerous.TimestampSigner(settings.session_secret)
+    return lambda data: signer.sign(b64encode(json.dumps(data).encode())).decode()
+
+
+@pytest.fixture
+def csrf_headers(client, session_cookie):
+    client.cookies.set("session", session_cookie({"csrf_token": "t"}))
+    return {"X-CSRF-Token": "t"}
+
+
 # ---- BeautifulSoup helper ----
 @pytest.fixture
 def soup():
@@ -0,0 +1,631 @@
+import asyncio
+from collections import Counter
+import json
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from eventcloud.event_broker import _split_utf8
+from eventcloud.event_broker import AdmissionRejected
+from eventcloud.event_broker import CLOSE
+from eventcloud.event_broker import EventBroker
+from eventcloud.event_broker import InProcessBackend
+from eventcloud.event_broker import InProcessHub
+from eventcloud.event_broker import parse_frame
+from eventcloud.event_broker import PING
+from eventcloud.event_broker import PostgresBackend
+from eventcloud.event_broker import RESYNC
+
+
+@pytest.mark.asyncio
+async def test_publish_reaches_local_subscribers():
+    broker = EventBroker()
+    queue = await broker.connect("code1")
+
+    await broker.publish("code1", "<p>hello</p>")
+
+    frame = queue.get_nowait()
+    assert frame.startswith(b"id: ")
+    assert frame.endswith(b"\nevent: message\ndata: <p>hello</p>\n\n")
+
+
+@pytest.mark.asyncio
+async def test_publish_fans_out_across_workers():
+    hub = InProcessHub()
+    worker_a = EventBroker(backend=InProcessBackend(hub))
+    worker_b = EventBroker(backend=InProcessBackend(hub))
+
+    queue_a = await worker_a.connect("code1")
+    queue_b = await worker_b.connect("code1")
+    other_event = await worker_b.connect("code2")
+
+    await worker_a.publish("code1", "<p>hello</p>")
+
+    assert queue_a.qsize() == 1
+    assert queue_b.qsize() == 1
+    assert other_event.empty()
+
+
+@pytest.mark.asyncio
+async def test_stopped_worker_no_longer_receives():
+    hub = InProcessHub()
+    worker_a = EventBroker(backend=InProcessBackend(hub))
+    worker_b = EventBroker(backend=InProcessBackend(hub))
+    queue_b = await worker_b.connect("code1")
+    await worker_b.stop()
+
+    await worker_a.publish("code1", "<p>hello</p>")
+
+    assert queue_b.empty()
+
+
+@pytest.mark.asyncio
+async def test_subscribers_receive_their_view_of_a_message():
+    broker = EventBroker()
+    html_queue = await broker.connect("code1")
+    json_queue = await broker.connect("code1", view="json")
+
+    await broker.publish("code1", {"html": "<p>hello</p>", "json": '{"text": "hello"}'})
+    await broker.publish("code1", "<p>html only</p>")
+
+    html_frames = [html_queue.get_nowait() for _ in range(html_queue.qsize())]
+    json_frames = [json_queue.get_nowait() for _ in range(json_queue.qsize())]
+    assert [f.split(b"\n")[-3] for f in html_frames] == [
+        b"data: <p>hello</p>",
+        b"data: <p>html only</p>",
+    ]
+    assert [f.split(b"\n")[-3] for f in json_frames] == [b'data: {"text": "hello"}']
+    # Both renderings of a message share one id so either view can resume from it
+    assert html_frames[0].split(b"\n")[0] == json_frames[0].split(b"\n")[0]
+    first_id = int(html_frames[0].split(b"\n")[0][4:])
+    assert broker.replay("code1", first_id - 1, view="json") == json_frames
+
+
+@pytest.mark.asyncio
+async def test_subscribers_receive_their_audience_variant():
+    broker = EventBroker()
+    broker.set_coalesce_window("code1", 0.01)
+    public = await broker.connect("code1")
+    preview = await broker.connect("code1", audience="preview")
+    staff = await broker.connect("code1", audience="staff")
+
+    await broker.publish("code1", {"html": "<p>Ana</p>", "html:preview": "<p>A**</p>"})
+    await broker.publish("code1", {"html": "<p>B</p>"})  # nothing to mask
+    await asyncio.sleep(0.05)
+
+    def data(q):
+        return q.get_nowait().decode().split("\n")[2:-2]
+
+    assert data(public) == ["data: <p>B</p>", "data: <p>Ana</p>"]
+    assert data(preview) == ["data: <p>B</p>", "data: <p>A**</p>"]
+    assert data(staff) == ["data: <p>B</p>", "data: <p>Ana</p>"]
+    assert broker.replay("code1", broker._floor, audience="preview")[0].endswith(b"<p>A**</p>\n\n")
+
+
+@pytest.mark.asyncio
+async def test_filtered_subscribers_only_get_their_topic():
+    broker = EventBroker(queue_size=2)
+    everything = await broker.connect("code1")
+    images = await broker.connect("code1", topic="images")
+    pinned = await broker.connect("code1", topic="pinned")
+    waiting = asyncio.create_task(pinned.get())
+    await asyncio.sleep(0)
+
+    for n in range(5):
+        await broker.publish("code1", f"<p>{n}</p>")
+    await broker.publish("code1", "<p>photo</p>", topics=("images",))
+    await broker.publish("code1", "<p>pin</p>", event="pin")
+
+    assert parse_frame(await asyncio.wait_for(waiting, 1)) == ("pin", "<p>pin</p>")
+    assert [parse_frame(f)[1] for f in drain(images)] == ["<p>photo</p>"]
+    assert len(drain(everything)) == 2  # the newest two, queue_size drops the rest
+    # Frames a filtered stream skips never count against it
+    assert broker.dropped_frames == {"code1": 5}
+    assert broker.replay("code1", broker._floor, topic="pinned") == [
+        broker.history["code1"].frames[-1][1]["html"]
+    ]
+    with pytest.raises(ValueError):
+        await broker.connect("code1", topic="everything")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy", ["drop_oldest", "collapse"])
+async def test_filtered_subscribers_fall_behind_by_wanted_frames_only(policy):
+    broker = EventBroker(queue_size=5, slow_consumer_policy=policy)
+    images = await broker.connect("code1", topic="images")  # not waiting, frames pile up
+
+    await broker.publish("code1", "<p>photo</p>", topics=("images",))
+    for n in range(10):
+        await broker.publish("code1", f"<p>{n}</p>")
+
+    assert images.qsize() == 1
+    assert parse_frame(images.get_nowait())[1] == "<p>photo</p>"
+    assert broker.dropped_frames == {}
+
+    for n in range(7):
+        await broker.publish("code1", f"<p>photo {n}</p>", topics=("images",))
+        await broker.publish("code1", f"<p>{n}</p>")
+    # Behind by 7 photos: only photos are dropped, and the newest ones are kept
+    kept = [parse_frame(f)[1] for f in drain(images)]
+    assert kept[-1] == "<p>photo 6</p>"
+    assert all("photo" in data or "missed" in data for data in kept)
+    assert broker.dropped_frames == {"code1": 2 if policy == "drop_oldest" else 6}
+
+
+@pytest.mark.asyncio
+async def test_coalescing_keeps_topics_in_separate_frames():
+    broker = EventBroker()
+    broker.set_coalesce_window("code1", 0.01)
+    everything = await broker.connect("code1")
+    images = await broker.connect("code1", topic="images")
+
+    await broker.publish("code1", "<p>text</p>")
+    await broker.publish("code1", "<p>photo 1</p>", topics=("images",))
+    await broker.publish("code1", "<p>photo 2</p>", topics=("images",))
+    await asyncio.sleep(0.05)
+
+    assert [parse_frame(f)[1] for f in drain(everything)] == [
+        "<p>text</p>",
+        "<p>photo 2</p>\n<p>photo 1</p>",
+    ]
+    assert [parse_frame(f)[1] for f in drain(images)] == ["<p>photo 2</p>\n<p>photo 1</p>"]
+    assert broker.coalesce_stats["code1"].frames == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatch_publishes_in_the_background_in_order():
+    broker = EventBroker()
+    queue = await broker.connect("code1")
+
+    for n in range(3):
+        broker.dispatch("code1", f"<p>{n}</p>")
+    broker.dispatch("code1", "<p>pin</p>", event="pin", received_at=time.perf_counter())
+    assert queue.empty()  # nothing was published on the caller's time
+
+    await broker.stop()
+    frames = [parse_frame(queue.get_nowait()) for _ in range(queue.qsize())]
+    assert frames == [
+        ("message", "<p>0</p>"),
+        ("message", "<p>1</p>"),
+        ("message", "<p>2</p>"),
+        ("pin", "<p>pin</p>"),
+    ]
+    assert broker.dispatch_seconds.count == 4
+    # Only messages that say when they arrived are timed from there
+    assert broker.message_seconds.count == 1
+
+
+@pytest.mark.asyncio
+async def test_presence_totals_reach_staff_only_when_they_change():
+    hub = InProcessHub()
+    worker_a = EventBroker(backend=InProcessBackend(hub), presence_interval=60)
+    worker_b = EventBroker(backend=InProcessBackend(hub), presence_interval=60)
+    staff = await worker_a.connect("code1", audience="staff")
+    public = await worker_a.connect("code1")
+    for _ in range(3):
+        await worker_b.connect("code1")
+    for _ in range(100):
+        q = await worker_b.connect("code1")
+        await worker_b.disconnect("code1", q)
+    assert staff.empty()  # joins and leaves on their own send nothing
+
+    await worker_a.report_presence()
+    await worker_b.report_presence()
+    worker_a.broadcast_presence()
+
+    assert worker_a.presence.totals() == worker_b.presence.totals() == {"code1": 5}
+    assert parse_frame(staff.get_nowait()) == (
+        "presence",
+        '<span id="viewerCount" hx-swap-oob="true">5 watching</span>',
+    )
+    assert public.empty()
+    worker_a.broadcast_presence()
+    assert staff.empty()  # unchanged totals are not sent again
+
+    await worker_a.stop()
+    await worker_b.stop()
+
+
+@pytest.mark.asyncio
+async def test_replay_returns_frames_after_last_event_id():
+    broker = EventBroker()
+    for n in range(3):
+        await broker.publish("code1", f"<p>{n}</p>")
+    first, second, third = [frames["html"] for _, frames, _ in broker.history["code1"].frames]
+    first_id = int(first.split(b"\n")[0][4:])
+
+    assert broker.replay("code1", first_id) == [second, third]
+    assert broker.replay("code1", broker.history["code1"].frames[-1][0]) == []
+
+
+@pytest.mark.asyncio
+async def test_workers_agree_on_ids_in_delivery_order(monkeypatch):
+    hub = InProcessHub()
+    worker_a = EventBroker(backend=InProcessBackend(hub))
+    worker_b = EventBroker(backend=InProcessBackend(hub))
+    await worker_a.start()
+    await worker_b.start()
+    # Clocks that disagree, as they do between machines
+    now = time.time_ns() // 1000
+    clock = iter([now + 2_000_000, now + 1_000_000, now + 3_000_000, now + 1_500_000])
+    monkeypatch.setattr(time, "time_ns", lambda: next(clock) * 1000)
+
+    for worker in (worker_a, worker_b, worker_a, worker_b):
+        await worker.publish("code1", "<p>hi</p>")
+
+    ids = [frame_id for frame_id, _, _ in worker_a.history["code1"].frames]
+    assert ids == [frame_id for frame_id, _, _ in worker_b.history["code1"].frames]
+    assert ids == [now + 2_000_000, now + 2_000_001, now + 3_000_000, now + 3_000_001]
+    assert worker_b.replay("code1", ids[1]) == worker_a.replay("code1", ids[1])
+    assert len(worker_a.replay("code1", ids[1])) == 2
+
+
+@pytest.mark.asyncio
+async def test_replay_gives_up_when_history_was_evicted():
+    broker = EventBroker(queue_size=2)
+    broker.HISTORY_SIZE = 2
+    await broker.publish("code1", "<p>0</p>")
+    first_id = broker.history["code1"].frames[-1][0]
+    for n in range(1, 3):
+        await broker.publish("code1", f"<p>{n}</p>")
+
+    # The first frame was evicted, so the broker can't vouch for what came before it
+    assert broker.replay("code1", first_id - 1) is None
+    assert len(broker.replay("code1", first_id)) == 2
+    assert broker.replay("unknown", broker._floor - 1) is None
+    assert broker.replay("unknown", broker._floor) == []
+
+
+@pytest.mark.asyncio
+async def test_shared_heartbeat_pings_idle_subscribers():
+    broker = EventBroker()
+    broker.HEARTBEAT_INTERVAL = 0.01
+    idle = await broker.connect("code1")
+    busy = await broker.connect("code2")
+    busy.put_nowait("frame")
+
+    await asyncio.sleep(0.05)
+
+    # Pings never pile up and never get queued behind real frames
+    assert idle.get_nowait() == PING
+    assert idle.empty()
+    assert busy.get_nowait() == "frame"
+
+    await broker.disconnect("code1", idle)
+    await broker.disconnect("code2", busy)
+    await asyncio.sleep(0.03)
+    assert broker._heartbeat.done()
+
+
+@pytest.mark.asyncio
+async def test_sweep_disconnects_orphaned_subscribers():
+    broker = EventBroker()
+    abandoned = await broker.connect("code1")
+    never_read = await broker.connect("code1")
+    active = await broker.connect("code1")
+    reading = asyncio.create_task(active.get())
+    # A stream task that died without reaching its disconnect
+    dead = asyncio.create_task(abandoned.get())
+    await asyncio.sleep(0)
+    dead.cancel()
+    await asyncio.sleep(0)
+    never_read.connected_at -= broker.ORPHAN_GRACE + 1
+
+    assert await broker.sweep_orphans() == 2
+
+    assert broker.channels == {"code1": {active}}
+    assert broker.subscriber_count == 1
+    assert broker.orphans_swept.value == 2
+    reading.cancel()
+
+
+@pytest.mark.asyncio
+async def test_coalescing_merges_a_burst_into_one_frame():
+    broker = EventBroker()
+    broker.set_coalesce_window("code1", 0.02)
+    queue = await broker.connect("code1")
+    other = await broker.connect("code2")
+
+    for n in range(3):
+        await broker.publish("code1", f"<p>{n}</p>")
+    await broker.publish("code2", "<p>now</p>")
+    assert queue.empty()
+    assert other.qsize() == 1
+
+    await asyncio.sleep(0.05)
+
+    frame = queue.get_nowait()
+    assert queue.empty()
+    # Newest first, like three frames swapped in with afterbegin
+    assert frame.endswith(b"data: <p>2</p>\ndata: <p>1</p>\ndata: <p>0</p>\n\n")
+    stats = broker.coalesce_stats["code1"]
+    assert (stats.frames, stats.fragments) == (1, 3)
+    assert stats.max_delay >= 0.02
+
+
+@pytest.mark.asyncio
+async def test_pin_goes_out_after_the_pending_burst():
+    broker = EventBroker(coalesce_window=10)
+    queue = await broker.connect("code1")
+
+    await broker.publish("code1", "<p>hello</p>")
+    await broker.publish("code1", "<p>pin</p>", event="pin")
+
+    frames = [parse_frame(queue.get_nowait()) for _ in range(queue.qsize())]
+    assert frames == [("message", "<p>hello</p>"), ("pin", "<p>pin</p>")]
+    assert not broker._pending
+
+
+@pytest.mark.asyncio
+async def test_stop_flushes_pending_burst():
+    broker = EventBroker(coalesce_window=10)
+    queue = await broker.connect("code1")
+    await broker.publish("code1", "<p>late</p>")
+
+    await broker.stop()
+
+    assert queue.get_nowait().endswith(b"data: <p>late</p>\n\n")
+
+
+def drain(queue):
+    frames = []
+    while not queue.empty():
+        frames.append(queue.get_nowait())
+    return frames
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy_keeps_newest_frames():
+    broker = EventBroker(queue_size=2, slow_consumer_policy="drop_oldest")
+    queue = await broker.connect("code1")
+
+    for n in range(5):
+        await broker.publish("code1", f"<p>{n}</p>")
+
+    frames = drain(queue)
+    assert [f.endswith(f"<p>{n}</p>\n\n".encode()) for f, n in zip(frames, (3, 4))] == [
+        True,
+        True,
+    ]
+    assert broker.dropped_frames == {"code1": 3}
+    # Subscribers are handed the ring's own copy of a frame
+    assert frames[-1] is broker.history["code1"].frames[-1][1]["html"]
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_ends_stream_with_resync_hint():
+    broker = EventBroker(queue_size=2)
+    broker.set_slow_consumer_policy("code1", "disconnect")
+    queue = await broker.connect("code1")
+
+    for n in range(4):
+        await broker.publish("code1", f"<p>{n}</p>")
+
+    assert drain(queue) == [RESYNC, CLOSE]
+    assert broker.dropped_frames == {"code1": 4}
+
+
+@pytest.mark.asyncio
+async def test_collapse_policy_replaces_backlog_with_notice():
+    broker = EventBroker(queue_size=2, slow_consumer_policy="collapse")
+    queue = await broker.connect("code1")
+
+    for n in range(6):
+        await broker.publish("code1", f"<p>{n}</p>")
+
+    notice, latest = drain(queue)
+    assert b"You missed 5 messages" in notice
+    assert latest.endswith(b"<p>5</p>\n\n")
+
+
+@pytest.mark.asyncio
+async def test_memory_budget_only_sheds_lagging_subscribers():
+    text = "x" * 300
+    frame_size = len(f"id: 1234567890123456\nevent: message\ndata: <p>{text}</p>\n\n")
+    broker = EventBroker(channel_budget=frame_size * 3, slow_consumer_policy="collapse")
+    lagging = await broker.connect("code1")
+    fast = await broker.connect("code1")
+
+    for _ in range(5):
+        await broker.publish("code1", f"<p>{text}</p>")
+        drain(fast)
+
+    assert broker.channel_bytes["code1"] <= frame_size * 3
+    # The lagging subscriber finds out it lost frames on its next read
+    assert b"You missed" in drain(lagging)[0]
+    assert broker.dropped_frames["code1"] >= 1
+
+    # Frames are held once per channel however many streams are open
+    await broker.disconnect("code1", lagging)
+    await broker.disconnect("code1", fast)
+    assert broker.channel_bytes["code1"] == broker.history["code1"].nbytes
+    assert broker.queued_bytes == broker.history["code1"].nbytes
+
+
+@pytest.mark.asyncio
+async def test_memory_budget_evicts_the_oldest_frames_of_any_channel():
+    text = "x" * 300
+    frame_size = len(f"id: 1234567890123456\nevent: message\ndata: <p>{text}</p>\n\n")
+    broker = EventBroker(memory_budget=frame_size * 4)
+    for _ in range(3):
+        await broker.publish("idle", f"<p>{text}</p>")
+    busy = await broker.connect("busy")
+
+    for _ in range(3):
+        await broker.publish("busy", f"<p>{text}</p>")
+        drain(busy)
+
+    # The idle channel's old frames went first, the busy one kept its history
+    assert broker.queued_bytes <= frame_size * 4
+    assert len(broker.history["busy"].frames) == 3
+    assert len(broker.history["idle"].frames) == 1
+
+
+@pytest.mark.asyncio
+async def test_idle_rings_are_dropped_after_their_ttl():
+    broker = EventBroker()
+    queue = await broker.connect("watched")
+    await broker.publish("watched", "<p>hi</p>")
+    await broker.publish("elsewhere", "<p>hi</p>")
+    last_id = broker.history["elsewhere"].frames[-1][0]
+
+    assert broker.expire_idle_rings() == 0
+    broker.IDLE_RING_TTL = 0
+    assert broker.expire_idle_rings() == 1
+    assert set(broker.history) == {"watched"}
+    assert broker.queued_bytes == broker.history["watched"].nbytes
+    # Its frames are gone, so resuming it needs the database
+    assert broker.replay("elsewhere", last_id - 1) is None
+    assert broker.replay("elsewhere", last_id) == []
+
+    await broker.disconnect("watched", queue)
+    assert broker.expire_idle_rings() == 1
+    assert broker.history == {} and broker.queued_bytes == 0
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        EventBroker(slow_consumer_policy="ignore")
+
+
+@pytest.mark.asyncio
+async def test_connection_limits():
+    broker = EventBroker()
+    broker.max_subscribers = 3
+    broker.max_subscribers_per_event = 2
+    first = await broker.connect("code1")
+    await broker.connect("code1")
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        await broker.connect("code1")
+    assert rejected.value.reason == "event_full"
+
+    await broker.connect("code2")
+    with pytest.raises(AdmissionRejected) as rejected:
+        await broker.connect("code3")
+    assert rejected.value.reason == "worker_full"
+
+    await broker.disconnect("code1", first)
+    await broker.connect("code1")
+    assert broker.rejected_connections == {"event_full": 1, "worker_full": 1}
+
+
+@pytest.mark.asyncio
+async def test_sheds_new_streams_while_loop_lags():
+    broker = EventBroker()
+    broker.shed_lag = 0.05
+    broker.lag_monitor.interval = 0.01
+    await broker.connect("code1")
+    await asyncio.sleep(0)  # let the monitor start timing
+
+    time.sleep(0.1)  # block the loop like a slow sync query would
+    await asyncio.sleep(0.005)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        await broker.connect("code1")
+    assert rejected.value.reason == "overloaded"
+
+
+@pytest.mark.asyncio
+async def test_drain_spreads_reconnects_over_the_window(monkeypatch):
+    broker = EventBroker()
+    clients, window_ms = 2000, 30_000
+    queues = [await broker.connect(f"code{n % 10}") for n in range(clients)]
+
+    # Seeded for this test only, the global random state is left alone
+    monkeypatch.setattr("eventcloud.event_broker.random", random.Random(13))
+    assert broker.drain(window_ms) == clients
+
+    retries = []
+    for q in queues:
+        retry = q.get_nowait()
+        assert retry.startswith(b"retry: ")
+        assert q.get_nowait() is CLOSE
+        retries.append(int(retry[7:]))
+    assert min(retries) >= 1000 and max(retries) <= window_ms
+
+    # Peak reconnects per second the next instance sees; all at once without jitter
+    per_second = Counter(r // 1000 for r in retries)
+    average = clients / (window_ms / 1000 - 1)
+    assert max(per_second.values()) < 1.5 * average
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        await broker.connect("code1")
+    assert rejected.value.reason == "draining"
+
+
+def test_postgres_chunks_reassemble():
+    delivered = []
+    backend = PostgresBackend("postgresql://unused")
+    backend._deliver = lambda code, frame, event_id: delivered.append((code, frame, event_id))
+
+    frames = {"html": "event: message\ndata: " + "ü" * 5000 + "\n\n"}
+    chunks = _split_utf8(json.dumps(frames), backend.CHUNK_SIZE)
+    assert len(chunks) > 1
+    assert all(len(c.encode()) <= backend.CHUNK_SIZE for c in chunks)
+
+    # Deliver out of order to make sure the listener waits for every piece
+    for idx in reversed(range(len(chunks))):
+        backend._receive(f"abc:{idx}:{len(chunks)}:42:code1\n{chunks[idx]}")
+
+    assert delivered == [("code1", frames, 42)]
+
+
+@pytest.mark.asyncio
+async def test_postgres_listener_reports_notifications_lost_while_reconnecting(monkeypatch):
+    connects = []
+
+    class Connection:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        async def execute(self, sql):
+            pass
+
+        async def notifies(self):
+            if len(connects) == 1:
+                raise OSError("server closed the connection")
+            await asyncio.Event().wait()
+            yield
+
+    async def connect(dsn, autocommit):
+        connects.append(dsn)
+        return Connection()
+
+    psycopg = SimpleNamespace(AsyncConnection=SimpleNamespace(connect=connect))
+    monkeypatch.setitem(sys.modules, "psycopg", psycopg)
+    backend = PostgresBackend("postgresql://unused")
+    backend.RECONNECT_DELAY = 0
+    lost = []
+    backend.lost = lambda: lost.append(len(connects))
+
+    listener = asyncio.create_task(backend._listen())
+    await asyncio.sleep(0.01)
+    listener.cancel()
+
+    # Told once it listens again, not on the first connect
+    assert lost == [2]
+
+
+@pytest.mark.asyncio
+async def test_resync_sends_resumes_and_open_streams_to_the_database():
+    broker = EventBroker()
+    queue = await broker.connect("code1")
+    await broker.publish("code1", "<p>1</p>")
+    seen = broker.history["code1"].frames[-1][0]
+    queue.get_nowait()
+
+    assert broker.resync() == 1
+    assert queue.get_nowait().startswith(b"retry: ")
+    assert queue.get_nowait() is CLOSE
+    # Frames after `seen` may never have arrived here
+    assert broker.replay("code1", seen) is None
+    assert broker.replay("other", seen) is None
+    await broker.publish("code1", "<p>2</p>")
+    assert broker.replay("code1", broker._floor) == [broker.history["code1"].frames[-1][1]["html"]]
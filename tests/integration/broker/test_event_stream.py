@@ -0,0 +1,131 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from starlette.requests import Request
+from starlette.testclient import TestClient
+
+from eventcloud.app import app
+from eventcloud.auth.deps import current_user
+from eventcloud.event_broker import broker
+from eventcloud.event_broker import parse_frame
+from eventcloud.models import EventMessage
+from eventcloud.utils import minify_fragment
+from eventcloud.utils import render_stream_payloads
+
+
+@pytest.mark.asyncio
+async def test_stream_rejected_past_event_limit(client, monkeypatch):
+    monkeypatch.setattr(broker, "max_subscribers_per_event", 1)
+    queue = await broker.connect("full1")
+    try:
+        resp = await client.get("/events/full1/stream")
+    finally:
+        await broker.disconnect("full1", queue)
+
+    # Browsers only read the retry delay from a successful stream
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    assert resp.headers["x-stream-rejected"] == "event_full"
+    assert int(resp.headers["retry-after"]) >= 1
+    retry_ms = int(resp.text.removeprefix("retry: ").removesuffix("\n\n"))
+    assert retry_ms >= 1000 * int(resp.headers["retry-after"])
+
+
+def test_websocket_receives_broker_frames_as_oob_swaps():
+    with TestClient(app) as test_client:
+        with test_client.websocket_connect("/events/ws1/ws") as ws:
+            test_client.portal.call(broker.publish, "ws1", "<p>hello</p>")
+            message = ws.receive_text()
+
+    assert message == '<div id="messages" hx-swap-oob="afterbegin"><p>hello</p></div>'
+    assert "ws1" not in broker.channels
+
+
+@pytest.mark.asyncio
+async def test_stream_rejects_unknown_format(client):
+    resp = await client.get("/events/code1/stream?format=xml")
+    assert resp.status_code == 422
+
+    resp = await client.get("/events/code1/stream?only=everything")
+    assert resp.status_code == 422
+
+
+def test_message_is_rendered_once_per_audience():
+    request = Request(
+        {
+            "type": "http",
+            "method": "POST",
+            "path": "/message/code1/",
+            "headers": [(b"hx-current-url", b"http://test/events/code1/")],
+            "session": {},
+            "query_string": b"",
+        }
+    )
+    message = EventMessage(
+        uuid="m1", event_id="code1", text="hi", sender_name="Ana", created_at=datetime.now()
+    )
+    message.images = []
+
+    payloads = render_stream_payloads(request, message)
+
+    assert set(payloads) == {"html", "html:preview", "html:staff", "json", "json:preview"}
+    assert "Ana" in payloads["html"] and "A**" in payloads["html:preview"]
+    assert "/pin/" in payloads["html:staff"] and "/pin/" not in payloads["html"]
+    assert '"sender_name":"A**"' in payloads["json:preview"]
+
+
+def test_fragments_are_minified_when_compiled():
+    source = """<div>
+      <!-- Pin button -->
+      {% if staff %}
+        <b>pin</b>
+      {% endif %}
+      {{ text }}
+      <span>a b</span>
+      <em>c</em>
+    </div>"""
+    # Inline tags keep a space between them, or their words would run together
+    assert minify_fragment(source) == (
+        "<div>{% if staff %} <b>pin</b> {% endif %} {{ text }} <span>a b</span> <em>c</em></div>"
+    )
+
+
+@pytest.mark.asyncio
+async def test_toggle_pin_publishes_out_of_band_move(
+    client, csrf_headers, normal_messages_for_single_event
+):
+    message = normal_messages_for_single_event[0]
+    queue = await broker.connect(message.event_id)
+    json_queue = await broker.connect(message.event_id, view="json")
+    try:
+        resp = await client.post(f"/message/{message.uuid}/pin/", headers=csrf_headers)
+        # Published by the background dispatcher
+        html_frame = await asyncio.wait_for(queue.get(), 1)
+        json_frame = await asyncio.wait_for(json_queue.get(), 1)
+    finally:
+        await broker.disconnect(message.event_id, queue)
+        await broker.disconnect(message.event_id, json_queue)
+
+    assert resp.status_code == 200
+    event, data = parse_frame(html_frame)
+    assert event == "pin"
+    assert f'<div id="message-{message.uuid}" hx-swap-oob="delete">' in data
+    assert 'hx-swap-oob="afterbegin:#pinnedMessages"' in data
+    event, data = parse_frame(json_frame)
+    assert event == "pin" and '"pinned":true' in data
+
+
+@pytest.mark.asyncio
+async def test_toggle_pin_needs_staff_and_csrf(
+    client, csrf_headers, normal_messages_for_single_event
+):
+    message = normal_messages_for_single_event[0]
+
+    no_token = await client.post(f"/message/{message.uuid}/pin/")
+    app.dependency_overrides[current_user] = lambda: SimpleNamespace(is_staff=False)
+    not_staff = await client.post(f"/message/{message.uuid}/pin/", headers=csrf_headers)
+
+    assert (no_token.status_code, not_staff.status_code) == (403, 403)
+    assert message.pinned is False
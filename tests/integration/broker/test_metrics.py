@@ -0,0 +1,63 @@
+import pytest
+
+from eventcloud.event_broker import broker
+from eventcloud.event_broker import EventBroker
+from eventcloud.metrics import Histogram
+from eventcloud.metrics import render_prometheus
+from eventcloud.metrics import snapshot
+from eventcloud.settings import settings
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram("test_seconds", "Test", (0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 5):
+        hist.observe(value)
+
+    lines = hist.render()
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+    assert "test_seconds_count 4" in lines
+
+
+@pytest.mark.asyncio
+async def test_broker_activity_is_recorded():
+    local = EventBroker(queue_size=1)
+    queue = await local.connect("code1")
+    await local.publish("code1", "<p>1</p>")
+    await local.publish("code1", "<p>2</p>")
+    await local.connect("code1")
+    local.ping()
+    queue.get_nowait()  # frames are dropped when a lagging subscriber reads
+    await local.disconnect("code1", queue)
+
+    data = snapshot(local)
+    assert data["subscribers"] == {"code1": 1}
+    assert data["dropped_frames"] == {"code1": 1}
+    assert data["fanout_seconds"]["count"] == 2
+    assert data["connection_seconds"]["count"] == 1
+    assert data["pings_sent"] == 1
+
+    text = render_prometheus(local)
+    assert 'eventcloud_broker_subscribers{event="code1"} 1' in text
+    assert 'eventcloud_broker_dropped_frames_total{event="code1"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client, monkeypatch):
+    monkeypatch.setattr(settings, "metrics_token", "scrape")
+    auth = {"Authorization": "Bearer scrape"}
+    queue = await broker.connect("metrics1")
+    try:
+        anonymous = await client.get("/metrics")
+        wrong = await client.get("/metrics", headers={"Authorization": "Bearer nope"})
+        text_resp = await client.get("/metrics", headers=auth)
+        json_resp = await client.get("/metrics", params={"format": "json"}, headers=auth)
+    finally:
+        await broker.disconnect("metrics1", queue)
+
+    # Labels name live events, so nothing is shown without the token
+    assert (anonymous.status_code, wrong.status_code) == (404, 404)
+    assert text_resp.status_code == 200
+    assert 'eventcloud_broker_subscribers{event="metrics1"} 1' in text_resp.text
+    assert json_resp.json()["subscribers"]["metrics1"] == 1
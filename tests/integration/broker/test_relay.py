@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from eventcloud.event_broker import EventBroker
+from eventcloud.event_broker import parse_frame
+from eventcloud.event_broker import RELAY_VIEW
+from eventcloud.relay import UpstreamBackend
+from eventcloud.settings import settings
+
+
+@pytest.mark.asyncio
+async def test_relay_feed_carries_every_rendering():
+    broker = EventBroker()
+    feed = await broker.connect("code1", view=RELAY_VIEW)
+
+    await broker.publish("code1", {"html": "<p>Ana</p>", "html:preview": "<p>A**</p>"})
+
+    frame = feed.get_nowait()
+    event, data = parse_frame(frame)
+    frames = json.loads(data)
+    assert event == RELAY_VIEW
+    assert set(frames) == {"html", "html:preview"}
+    assert frames["html"].endswith("data: <p>Ana</p>\n\n")
+    assert broker.replay("code1", broker._floor, view=RELAY_VIEW) == [frame]
+
+
+@pytest.mark.asyncio
+async def test_relay_serves_upstream_frames_unchanged():
+    upstream = EventBroker()
+    feed = await upstream.connect("code1", view=RELAY_VIEW)
+    direct = await upstream.connect("code1", audience="preview")
+    await upstream.publish("code1", {"html": "<p>Ana</p>", "html:preview": "<p>A**</p>"})
+    body = feed.get_nowait()
+
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, content=body if len(requests) == 1 else b"")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    backend = UpstreamBackend("http://app", "secret", client)
+    backend.RECONNECT_DELAY = 0.01
+    relay = EventBroker(backend=backend)
+    viewers = [await relay.connect("code1", audience="preview") for _ in range(3)]
+    backend.follow("code1")
+    backend.follow("code1")
+
+    frames = [await asyncio.wait_for(viewer.get(), 1) for viewer in viewers]
+    await asyncio.sleep(0.05)
+    await relay.stop()
+
+    assert frames == [direct.get_nowait()] * 3
+    assert requests[0].headers["authorization"] == "Bearer secret"
+    # One upstream connection at a time, resumed from the last frame it relayed
+    assert "last-event-id" not in requests[0].headers
+    assert requests[1].headers["last-event-id"] == str(upstream.history["code1"].frames[-1][0])
+    assert backend.feeds == {}
+
+
+@pytest.mark.asyncio
+async def test_relay_feed_needs_the_token(client, monkeypatch):
+    resp = await client.get("/events/code1/relay")
+    assert resp.status_code == 404
+
+    monkeypatch.setattr(settings, "relay_token", "secret")
+    resp = await client.get("/events/code1/relay", headers={"Authorization": "Bearer wrong"})
+    assert resp.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_clients_resuming_from_before_the_relay_catch_up_from_upstream():
+    upstream = EventBroker()
+    for n in range(3):
+        await upstream.publish("code1", {"html": f"<p>{n}</p>", "html:preview": f"<p>*{n}</p>"})
+    first, second, third = (frame_id for frame_id, _, _ in upstream.history["code1"].frames)
+    newer = upstream.replay("code1", first, view=RELAY_VIEW)
+    relayed = b"".join(newer)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, content=relayed)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    backend = UpstreamBackend("http://app", "secret", client)
+    relay = EventBroker(backend=backend)
+    backend._deliver = relay._deliver
+    # The relay itself already has the newest frame, the client gets it from there
+    backend._deliver("code1", json.loads(parse_frame(newer[-1])[1]))
+
+    viewer = await relay.connect("code1", audience="preview")
+    ring = relay.history["code1"]
+    backlog = await backend.catch_up(
+        "code1", first, lambda frame_id: frame_id >= ring.frames[0][0], audience="preview"
+    )
+    await relay.stop()
+
+    assert requests[0].headers["last-event-id"] == str(first)
+    assert [parse_frame(frame)[1] for frame in backlog] == ["<p>*1</p>"]
+    assert backlog[0].startswith(f"id: {second}\n".encode())
+    assert viewer.empty() and ring.frames[0][0] == third
+
+
+@pytest.mark.asyncio
+async def test_clients_are_told_when_upstream_cant_catch_them_up():
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(502)))
+    backend = UpstreamBackend("http://app", "secret", client)
+
+    html = await backend.catch_up("code1", 1, lambda frame_id: False)
+    records = await backend.catch_up("code1", 1, lambda frame_id: False, view="json")
+
+    assert "You missed some messages" in parse_frame(html[-1])[1]
+    assert json.loads(parse_frame(records[-1])[1]) == {"type": "missed", "missed": None}
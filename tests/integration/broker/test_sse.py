@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from eventcloud.event_broker import EventBroker
+from eventcloud.sse import broker_stream
+from eventcloud.sse import EventStreamResponse
+
+
+@pytest.mark.asyncio
+async def test_stream_stops_when_client_disconnects():
+    closed = asyncio.Event()
+    sent = []
+
+    async def generator():
+        try:
+            yield "event: message\ndata: hi\n\n"
+            await asyncio.Event().wait()  # an idle stream, nothing else to send
+        finally:
+            closed.set()
+
+    async def receive():
+        await asyncio.sleep(0.01)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    await asyncio.wait_for(EventStreamResponse(generator())(scope, receive, send), 1)
+
+    assert closed.is_set()
+    assert sent[0]["type"] == "http.response.start"
+    assert (b"content-type", b"text/event-stream; charset=utf-8") in sent[0]["headers"]
+    assert sent[1]["body"] == b"event: message\ndata: hi\n\n"
+
+
+@pytest.mark.asyncio
+async def test_on_close_runs_when_a_write_fails():
+    closed = []
+
+    async def generator():
+        yield "event: message\ndata: hi\n\n"
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            raise OSError("client vanished mid-write")
+
+    async def on_close():
+        closed.append(True)
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    response = EventStreamResponse(generator(), on_close=on_close)
+    with pytest.raises(Exception):
+        await asyncio.wait_for(response(scope, receive, send), 1)
+
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_async_fallbacks_are_awaited_on_the_loop():
+    broker = EventBroker()
+
+    async def fallback(last_event_id):
+        return [f"id: {last_event_id + 1}\nevent: message\ndata: missed\n\n".encode()]
+
+    resp = await broker_stream(broker, "code1", 1, fallback=fallback)
+    first = await anext(resp.body_iterator)
+    await resp.body_iterator.aclose()
+    await broker.stop()
+
+    assert first == b"id: 2\nevent: message\ndata: missed\n\n"
@@ -1,4 +1,31 @@
+from datetime import datetime
+from datetime import timedelta
+from functools import partial
+import json
+
 import pytest
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import sessionmaker
+from starlette.requests import Request
+
+from eventcloud.app import replay_messages_from_db
+from eventcloud.event_broker import EventBroker
+from eventcloud.event_broker import parse_frame
+from eventcloud.ingest import message_writer
+from eventcloud.ingest import MessageWriter
+from eventcloud.models import Event
+from eventcloud.models import EventMessage
+from eventcloud.sse import broker_stream
+from eventcloud.utils import render_stream_data
+
+REQUEST_SCOPE = {
+    "type": "http",
+    "method": "POST",
+    "path": "/message/test123/",
+    "headers": [],
+    "session": {},
+    "query_string": b"",
+}
 
 
 @pytest.mark.asyncio
@@ -98,3 +125,111 @@ async def test_event_wall_pinned_on_top(client, soup, single_event, all_messages
         assert (
             normal_msg.text in items[len(pinned) - (idx + 1)]
         )  # Reverse indexing is due to latest message will always be on top
+
+
+@pytest.mark.asyncio
+async def test_event_wall_transport(client, soup, single_event):
+    resp = await client.get(f"/events/{single_event.code}/")
+    main = soup(resp.text).select_one("main#messages")
+    assert main["sse-connect"] == f"/events/{single_event.code}/stream?audience=public"
+
+    resp = await client.get(f"/events/{single_event.code}/", params={"transport": "ws"})
+    main = soup(resp.text).select_one("main#messages")
+    assert main["ws-connect"] == f"/events/{single_event.code}/ws?audience=public"
+    assert not main.has_attr("sse-connect")
+
+
+@pytest.mark.asyncio
+async def test_message_and_images_are_written_without_reading_back(engine, session, soup):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement.split()[0])
+
+    writer = MessageWriter(sessions=sessionmaker(bind=session.connection()), batch_ms=0)
+    sa_event.listen(engine, "before_cursor_execute", record)
+    try:
+        message = await writer.write("test123", "hi", "Ana", ["a.jpg", "b.jpg"])
+        html = render_stream_data(Request(REQUEST_SCOPE), message, "html", "public")
+    finally:
+        sa_event.remove(engine, "before_cursor_execute", record)
+
+    # The message, then both images in one statement, and nothing read back to render
+    assert statements == ["INSERT", "INSERT"]
+    dom = soup(html)
+    assert "hi" in dom.text
+    assert [d["hx-get"] for d in dom.select("[hx-get]")] == [
+        "/messageimage/?key=a.jpg",
+        "/messageimage/?key=b.jpg",
+    ]
+
+
+def test_replay_from_db_overlaps_and_says_when_it_truncates(session, single_event, monkeypatch):
+    monkeypatch.setattr("eventcloud.app.SessionLocal", sessionmaker(bind=session.connection()))
+    start = datetime(2026, 1, 1, 12)
+    messages = [
+        EventMessage(event_id="test123", text=f"m{n}", created_at=start + timedelta(seconds=n))
+        for n in range(4)
+    ]
+    session.add_all(messages)
+    session.commit()
+    # The client last saw a frame numbered after m1 was created, m1 went out after it
+    cursor = messages[1].stream_event_id + 500_000
+    replay = partial(
+        replay_messages_from_db, Request(REQUEST_SCOPE), "test123", cursor, "json", "public"
+    )
+
+    records = [json.loads(parse_frame(frame)[1]) for frame in replay()]
+    assert [r["text"] for r in records] == ["m0", "m1", "m2", "m3"]
+
+    monkeypatch.setattr("eventcloud.app.REPLAY_LIMIT", 2)
+    frames = replay()
+    assert not frames[0].startswith("id: ")
+    records = [json.loads(parse_frame(frame)[1]) for frame in frames]
+    assert records[0] == {"type": "missed", "missed": 2}
+    assert [r["text"] for r in records[1:]] == ["m2", "m3"]
+
+
+@pytest.mark.asyncio
+async def test_async_paths_keep_queries_off_the_event_loop(
+    client,
+    session,
+    monkeypatch,
+    loop_blocking_queries,
+    normal_messages_for_single_event,
+    session_cookie,
+    csrf_headers,
+):
+    Session = sessionmaker(bind=session.connection())
+    for module in (
+        "eventcloud.app",
+        "eventcloud.routes.events",
+        "eventcloud.auth.session_backend",
+    ):
+        monkeypatch.setattr(f"{module}.SessionLocal", Session)
+    monkeypatch.setattr(message_writer, "sessions", Session)
+    # Outer session for SessionAuthBackend, inner one for the routes
+    client.cookies.set("sessionid", session_cookie({"uid": 1}))
+    message_uuid = normal_messages_for_single_event[0].uuid
+    event = session.get(Event, normal_messages_for_single_event[0].event_id)
+    code, uuid = event.code, event.uuid
+    loop_blocking_queries.clear()  # the test's own setup, only the app's queries count
+
+    resp = await client.post("/events/", data={"code": "new1", "title": "New", "description": ""})
+    assert resp.status_code == 302
+    form = {"csrf_token": "t", "code": code, "title": "B", "description": ""}
+    resp = await client.post(f"/manage/events/{uuid}", data=form)
+    assert resp.status_code == 303
+    resp = await client.post(f"/message/{code}/", data={"text": "hi", "sender_name": "Ana"})
+    assert resp.status_code == 200
+    resp = await client.post(f"/message/{message_uuid}/pin/", headers=csrf_headers)
+    assert resp.status_code == 200
+    broker = EventBroker()
+    replay = partial(
+        replay_messages_from_db, Request(REQUEST_SCOPE), code, view="html", audience="public"
+    )
+    await broker_stream(broker, code, 1, fallback=replay)
+    await broker.stop()
+
+    assert loop_blocking_queries == []
+    assert session.get(Event, "new1") is not None
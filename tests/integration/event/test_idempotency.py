@@ -0,0 +1,75 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+from sqlalchemy import event
+
+from eventcloud.event_broker import broker
+from eventcloud.idempotency import recent_posts
+from eventcloud.idempotency import RecentKeys
+from eventcloud.ingest import message_writer
+from eventcloud.models import EventMessage
+
+POST = {"text": "hi", "sender_name": "Ana", "idempotency_key": "k1"}
+
+
+@pytest.fixture
+def app_sessions(sessions, monkeypatch):
+    # The app writes to the test's own database, where the duplicate insert really rolls back
+    monkeypatch.setattr(message_writer, "sessions", sessions)
+    monkeypatch.setattr("eventcloud.routes.events.SessionLocal", sessions)
+    monkeypatch.setattr(recent_posts, "entries", OrderedDict())
+    return sessions
+
+
+@pytest.mark.asyncio
+async def test_retries_are_stored_and_published_once(client, app_sessions):
+    statements = []
+    event.listen(
+        app_sessions.kw["bind"], "before_cursor_execute", lambda *a: statements.append(a[2])
+    )
+    queue = await broker.connect("dedupe1")
+    try:
+        first, retry = await asyncio.gather(
+            client.post("/message/dedupe1/", data=POST),
+            client.post("/message/dedupe1/", data=POST),
+        )
+        late_retry = await client.post("/message/dedupe1/", data=POST)
+        await asyncio.wait_for(queue.get(), 1)
+        await asyncio.sleep(0.05)
+        published = 1 + queue.qsize()
+    finally:
+        await broker.disconnect("dedupe1", queue)
+
+    assert [r.status_code for r in (first, retry, late_retry)] == [200, 200, 200]
+    assert published == 1
+    # Retries were answered from memory, the database only saw the original
+    assert [s.split()[0] for s in statements] == ["INSERT"]
+    with app_sessions() as db:
+        assert db.query(EventMessage).count() == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_on_another_worker_is_recognised(client, app_sessions):
+    resp = await client.post("/message/dedupe2/", data=POST)
+    assert resp.status_code == 200
+    recent_posts.entries.clear()  # as if the retry reached a worker that never saw the key
+
+    resp = await client.post("/message/dedupe2/", data=POST)
+    other = await client.post("/message/dedupe2/", data={**POST, "idempotency_key": "k2"})
+
+    assert (resp.status_code, other.status_code) == (200, 200)
+    with app_sessions() as db:
+        assert db.query(EventMessage).count() == 2
+
+
+@pytest.mark.asyncio
+async def test_keys_expire_and_stay_bounded(clock):
+    keys = RecentKeys(ttl=60, max_keys=2, clock=clock)
+
+    for key in ("a", "b", "c"):
+        keys.add(key)
+    assert keys.seen("a") is None and keys.seen("c") is not None
+
+    clock.now = 61
+    assert keys.seen("c") is None and not keys.entries
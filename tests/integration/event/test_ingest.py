@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+from sqlalchemy import event
+
+from eventcloud.ingest import MessageWriter
+from eventcloud.models import EventMessage
+
+
+@pytest.mark.asyncio
+async def test_burst_is_stored_in_batched_transactions(sessions):
+    engine = sessions.kw["bind"]
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    event.listen(engine, "commit", lambda conn: statements.append("COMMIT"))
+    writer = MessageWriter(sessions, batch_ms=50, batch_size=4)
+
+    messages = await asyncio.gather(
+        *(writer.write("code1", f"hi {n}", "Ana", ["a.jpg"] if n == 0 else []) for n in range(6))
+    )
+    await writer.stop()
+
+    # A transaction per batch: messages then images for the first 4, then the other 2
+    assert [s.split()[0] for s in statements] == [
+        *("INSERT", "INSERT", "COMMIT"),
+        *("INSERT", "COMMIT"),
+    ]
+    assert (writer.batches, writer.rows) == (2, 6)
+    assert [m.text for m in messages] == [f"hi {n}" for n in range(6)]
+    assert [i.image_key for i in messages[0].images] == ["a.jpg"]
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_only_fails_the_bad_message(sessions):
+    writer = MessageWriter(sessions, batch_ms=50)
+
+    results = await asyncio.gather(
+        writer.write("code1", "fine", "Ana"),
+        writer.write("code1", "bad", "Ana", [None]),  # image_key is NOT NULL
+        return_exceptions=True,
+    )
+    await writer.stop()
+
+    assert results[0].text == "fine"
+    assert isinstance(results[1], Exception)
+    with sessions() as db:
+        assert [m.text for m in db.query(EventMessage)] == ["fine"]
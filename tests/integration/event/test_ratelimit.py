@@ -0,0 +1,67 @@
+from ipaddress import ip_network
+
+import pytest
+from starlette.requests import Request
+
+from eventcloud.metrics import rate_limited
+from eventcloud.ratelimit import client_ip
+from eventcloud.ratelimit import RateLimiter
+
+
+def test_buckets_refill_and_refusals_take_nothing(clock):
+    limiter = RateLimiter("test", {"sender": 2, "ip": 60}, clock=clock)
+
+    assert [limiter.hit(sender="ana", ip="1.1.1.1") for _ in range(3)] == [0, 0, 30]
+    # Ana's refusal didn't cost the shared IP a token
+    assert limiter.scopes["ip"].tokens("1.1.1.1", clock.now) == 58
+    assert limiter.hit(sender="ben", ip="1.1.1.1") == 0
+    assert rate_limited["test:sender"] == 1
+
+    clock.now = 30
+    assert limiter.hit(sender="ana", ip="1.1.1.1") == 0
+    assert limiter.hit(sender="ana", ip="1.1.1.1") == 30
+
+
+def test_least_recently_used_buckets_are_dropped(clock):
+    limiter = RateLimiter("test", {"ip": 1}, max_keys=2, clock=clock)
+
+    for ip in ("a", "b", "a", "c"):
+        limiter.hit(ip=ip)
+
+    assert list(limiter.scopes["ip"].buckets) == ["a", "c"]
+
+
+@pytest.mark.asyncio
+async def test_posting_past_the_limit_is_refused(client, monkeypatch):
+    limiter = RateLimiter("message", {"ip": 1})
+    monkeypatch.setattr("eventcloud.routes.events.message_limits", limiter)
+    limiter.hit(ip="127.0.0.1")
+
+    resp = await client.post("/message/code1/", data={"text": "hi", "sender_name": "Ana"})
+
+    assert resp.status_code == 429
+    assert resp.headers["retry-after"] == "60"
+
+
+def test_forwarded_for_is_only_believed_from_trusted_proxies(monkeypatch):
+    monkeypatch.setattr("eventcloud.ratelimit.TRUSTED_PROXIES", [ip_network("10.0.0.0/8")])
+
+    def request(peer, forwarded_for):
+        headers = [(b"x-forwarded-for", forwarded_for.encode())]
+        return Request({"type": "http", "client": (peer, 1234), "headers": headers})
+
+    # The client's own X-Forwarded-For entries are left of what the proxies appended
+    assert client_ip(request("10.0.0.2", "6.6.6.6, 1.2.3.4, 10.0.0.1")) == "1.2.3.4"
+    assert client_ip(request("5.5.5.5", "6.6.6.6")) == "5.5.5.5"
+
+
+@pytest.mark.asyncio
+async def test_senders_are_limited_by_session_not_name(client, monkeypatch, session_cookie):
+    limiter = RateLimiter("message", {"sender": 1})
+    monkeypatch.setattr("eventcloud.routes.events.message_limits", limiter)
+    client.cookies.set("session", session_cookie({"csrf_token": "s1"}))
+    limiter.hit(sender=("code1", "s1"))
+
+    resp = await client.post("/message/code1/", data={"text": "hi", "sender_name": "Someone else"})
+
+    assert resp.status_code == 429
@@ -0,0 +1,107 @@
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import event
+
+from eventcloud.event_broker import EventBroker
+from eventcloud.models import EventMessage
+from eventcloud.schemas import EventMessageStreamRecord
+from eventcloud.wall_cache import wall_cache
+
+
+@pytest.fixture
+def statements(engine):
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    yield executed
+    event.remove(engine, "before_cursor_execute", count)
+
+
+@pytest.mark.asyncio
+async def test_wall_renders_from_memory_after_first_load(
+    client, single_event, normal_messages_for_single_event, statements
+):
+    first = await client.get(f"/events/{single_event.code}/")
+    loaded_with, hits = len(statements), wall_cache.hits
+    second = await client.get(f"/events/{single_event.code}/")
+
+    assert loaded_with > 0
+    assert len(statements) == loaded_with
+    assert first.text == second.text
+    assert wall_cache.hits == hits + 1
+
+
+@pytest.mark.asyncio
+async def test_new_messages_reach_cached_wall(client, soup, session, single_event, statements):
+    url = f"/events/{single_event.code}/"
+    await client.get(url)
+
+    message = EventMessage(event_id=single_event.code, text="Fresh one", sender_name="Ana")
+    session.add(message)
+    session.commit()
+    wall_cache.update_message(message)
+    statements.clear()
+
+    resp = await client.get(url)
+
+    assert statements == []
+    assert "Fresh one" in soup(resp.text).select_one("main#messages").get_text()
+
+
+def test_pin_moves_message_between_lists(session, single_event, normal_messages_for_single_event):
+    wall = wall_cache.get(session, single_event.code)
+    message = normal_messages_for_single_event[0]
+
+    message.pinned = True
+    wall_cache.update_message(message)
+
+    assert [m.uuid for m in wall.pinned] == [message.uuid]
+    assert message.uuid not in [m.uuid for m in wall.recent]
+
+
+def test_pin_from_a_full_page_reloads_the_wall(session, single_event):
+    now = datetime.now()
+    messages = [
+        EventMessage(event_id=single_event.code, text=str(n), created_at=now + timedelta(n))
+        for n in range(wall_cache.page_size + 1)
+    ]
+    session.add_all(messages)
+    session.commit()
+    wall_cache.get(session, single_event.code)
+
+    newest = messages[-1]
+    newest.pinned = True
+    session.commit()
+    wall_cache.update_message(newest)
+    wall = wall_cache.get(session, single_event.code)
+
+    assert [m.text for m in wall.pinned] == [newest.text]
+    # The eleventh message moved up into the first page
+    assert len(wall.recent) == wall_cache.page_size
+    assert wall.recent[-1].text == "0"
+
+
+@pytest.mark.asyncio
+async def test_broker_frames_update_every_worker(session, single_event):
+    broker = EventBroker()
+    broker.listeners.append(wall_cache.apply_frames)
+    wall_cache.get(session, single_event.code)
+    record = EventMessageStreamRecord(
+        uuid="m1",
+        text="From another worker",
+        sender_name="Ben",
+        created_at=datetime.now(),
+        image_keys=["uploads/a.jpg"],
+        pinned=False,
+    )
+
+    await broker.publish(single_event.code, {"json": record.model_dump_json()})
+
+    wall = wall_cache.get(session, single_event.code)
+    assert [m.text for m in wall.recent] == ["From another worker"]
+    assert [i.image_key for i in wall.recent[0].images] == ["uploads/a.jpg"]
@@ -0,0 +1,72 @@
+"""
+bytes per streamed message: fragment templates as written vs minified when compiled
+
+- renders a realistic mix of messages through _messages.html like send_message does,
+  for the public and the staff audience (staff cards carry the pin button)
+- "as written": a renderer over the same templates without the minifier, what
+  MINIFY_FRAGMENTS=0 serves
+- "minified": utils.jinja as the app uses it
+- prints the sse frame bytes per message for each, frames are what every
+  connected viewer downloads
+
+usage:
+  PYTHONPATH=src python tests/x_bench_fragment_bytes.py --messages 200
+"""
+
+import argparse
+import os
+import random
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+import air  # noqa: E402
+from x_bench_ws_bandwidth import fake_message  # noqa: E402
+from x_bench_ws_bandwidth import poster_request  # noqa: E402
+
+from eventcloud.event_broker import format_frame  # noqa: E402
+from eventcloud.utils import BASE_DIR  # noqa: E402
+from eventcloud.utils import jinja  # noqa: E402
+from eventcloud.utils import message_audience  # noqa: E402
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--seed", type=int, default=7)
+    return p.parse_args()
+
+
+def frame_bytes(renderer, request, message, audience):
+    html = renderer(request, "_messages.html", {"messages": [message], "audience": audience})
+    payload = '<span data-autoscroll="1" style="display:none"></span>' + html.body.decode()
+    return len(format_frame(payload, 1_700_000_000_000_000).encode())
+
+
+def main():
+    args = parse_args()
+    as_written = air.JinjaRenderer(directory=str(BASE_DIR / "templates"))
+    as_written.templates.env.globals["message_audience"] = message_audience
+    request = poster_request("bench")
+
+    print("\n=== stream frame bytes per message ===")
+    print(f"messages: {args.messages}")
+    for audience in ("public", "staff"):
+        rng = random.Random(args.seed)
+        messages = [fake_message(rng, "bench") for _ in range(args.messages)]
+        before = sum(frame_bytes(as_written, request, m, audience) for m in messages)
+        after = sum(frame_bytes(jinja, request, m, audience) for m in messages)
+        print(
+            f"{audience:7} as written: {before / args.messages:7.0f} B, "
+            f"minified: {after / args.messages:7.0f} B, "
+            f"{(1 - after / before) * 100:4.1f}% smaller"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+idle sse connection cpu benchmark
+
+- simulates n idle /events/{code}/stream connections inside one event loop
+- "before": every connection polls request.is_disconnected() and waits on its queue
+  with asyncio.wait_for(timeout=interval), like the original generator()
+- "after": connections block on their queue and a single EventBroker heartbeat
+  pings every idle queue once per interval
+- prints process cpu time per 1k connections per heartbeat cycle
+
+usage:
+  PYTHONPATH=src python tests/x_bench_idle_streams.py --clients 2000 --interval 0.5 --cycles 10
+
+notes:
+- the interval is shortened from the production 15s so that the heartbeat cost
+  dominates the measurement; cpu per cycle is what scales with idle viewers.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+from starlette.requests import Request  # noqa: E402
+
+from eventcloud.event_broker import EventBroker  # noqa: E402
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--clients", type=int, default=2000)
+    p.add_argument("--interval", type=float, default=0.5, help="heartbeat interval (s)")
+    p.add_argument("--cycles", type=int, default=10, help="heartbeat cycles to measure")
+    return p.parse_args()
+
+
+def idle_request():
+    never = asyncio.Event()
+
+    async def receive():
+        await never.wait()
+
+    return Request({"type": "http", "method": "GET", "headers": []}, receive)
+
+
+async def polling_client(request, queue, interval, sink):
+    # The original per-connection loop
+    while True:
+        if await request.is_disconnected():
+            break
+        try:
+            sink.append(await asyncio.wait_for(queue.get(), timeout=interval))
+        except asyncio.TimeoutError:
+            sink.append(": ping\n\n")
+
+
+async def blocking_client(queue, sink):
+    while True:
+        sink.append(await queue.get())
+
+
+async def measure(tasks, args):
+    await asyncio.sleep(args.interval)  # let every client reach its first await
+    cpu = time.process_time()
+    await asyncio.sleep(args.interval * args.cycles)
+    used = time.process_time() - cpu
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return used
+
+
+async def run_before(args):
+    sink = []
+    tasks = [
+        asyncio.create_task(
+            polling_client(idle_request(), asyncio.Queue(maxsize=100), args.interval, sink)
+        )
+        for _ in range(args.clients)
+    ]
+    return await measure(tasks, args), len(sink)
+
+
+async def run_after(args):
+    sink = []
+    broker = EventBroker()
+    broker.HEARTBEAT_INTERVAL = args.interval
+    tasks = []
+    for _ in range(args.clients):
+        queue = await broker.connect("bench")
+        tasks.append(asyncio.create_task(blocking_client(queue, sink)))
+    used = await measure(tasks, args)
+    await broker.stop()
+    return used, len(sink)
+
+
+async def main():
+    args = parse_args()
+    print("\n=== idle stream heartbeat benchmark ===")
+    print(f"clients: {args.clients}, interval: {args.interval}s, cycles: {args.cycles}")
+    for label, run in (
+        ("before (wait_for per client)", run_before),
+        ("after (shared)", run_after),
+    ):
+        used, pings = await run(args)
+        per_k_ms = used / args.cycles / (args.clients / 1000) * 1000
+        print(f"{label:30} cpu: {used:.3f}s, pings: {pings}, cpu/1k conns/cycle: {per_k_ms:.2f}ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
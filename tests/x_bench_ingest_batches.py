@@ -0,0 +1,114 @@
+"""
+message ingestion throughput vs group commit batch size
+
+- concurrent posters each write messages one after another through MessageWriter,
+  the way send_message does, and wait for the commit like a request would
+- batch size "off" is INGEST_BATCH_MS=0, every message commits on its own from the
+  threadpool; the others use --window ms and that many messages per transaction
+- prints messages per second, median and p99 time until a message is acknowledged,
+  and the average rows per transaction
+- runs against a fresh sqlite file by default, pass --database-url to use another
+  database; tables are created if missing and the rows written are deleted after
+
+usage:
+  PYTHONPATH=src python tests/x_bench_ingest_batches.py --clients 200 --messages 4000
+  PYTHONPATH=src python tests/x_bench_ingest_batches.py \\
+      --database-url postgresql+psycopg://localhost/eventcloud_bench
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from eventcloud.db import Base  # noqa: E402
+from eventcloud.ingest import MessageWriter  # noqa: E402
+from eventcloud.models import Event  # noqa: E402
+from eventcloud.models import EventMessage  # noqa: E402
+
+CODE = "ingestbench"
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--messages", type=int, default=4000)
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128, 512])
+    p.add_argument("--window", type=float, default=5, help="INGEST_BATCH_MS")
+    p.add_argument("--database-url", default="")
+    return p.parse_args()
+
+
+def cleanup(Session, recreate=False):
+    with Session() as db:
+        db.query(EventMessage).filter_by(event_id=CODE).delete(synchronize_session=False)
+        db.query(Event).filter_by(code=CODE).delete(synchronize_session=False)
+        if recreate:
+            db.add(Event(code=CODE, title="Ingest bench"))
+        db.commit()
+
+
+async def post(writer, count, latencies):
+    for n in range(count):
+        started = time.perf_counter()
+        await writer.write(CODE, f"message {n}", "Ana")
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(Session, clients, messages, batch_ms, batch_size):
+    writer = MessageWriter(Session, batch_ms=batch_ms, batch_size=batch_size)
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(post(writer, messages // clients, latencies) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    await writer.stop()
+    latencies.sort()
+    return (
+        len(latencies) / elapsed,
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99)],
+        writer.rows / writer.batches,
+    )
+
+
+async def main():
+    args = parse_args()
+    url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    engine = create_engine(
+        url, connect_args={"check_same_thread": False} if "sqlite" in url else {}
+    )
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    cleanup(Session, recreate=True)
+
+    print("\n=== ingestion throughput vs batch size ===")
+    print(f"database: {engine.dialect.name}, clients: {args.clients}, messages: {args.messages}")
+    for batch_size in (None, *args.batch_sizes):
+        batch_ms = args.window if batch_size else 0
+        rate, p50, p99, rows = await run(
+            Session, args.clients, args.messages, batch_ms, batch_size
+        )
+        print(
+            f"batch size: {batch_size or 'off':>4}, {rate:8.0f} messages/s, "
+            f"ack p50: {p50 * 1000:7.1f}ms, p99: {p99 * 1000:7.1f}ms, "
+            f"rows per transaction: {rows:6.1f}"
+        )
+        cleanup(Session, recreate=True)
+    cleanup(Session)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+"""
+message write throughput: send_message's old write path vs MessageWriter
+
+- "old": commit the message, refresh it, add the images, commit, refresh, then
+  query it again with selectinload(images), like send_message used to
+- "writer": MessageWriter committing each message on its own (INGEST_BATCH_MS=0),
+  one transaction with an INSERT for the message and one for all its images
+- every message has 0 to 3 images, 30% of them have any
+- prints messages per second and statements sent per message for each path
+- runs against a fresh sqlite file by default, pass --database-url to use another
+  database; tables are created if missing and the rows written are deleted after
+
+usage:
+  PYTHONPATH=src python tests/x_bench_message_writes.py --messages 2000
+  PYTHONPATH=src python tests/x_bench_message_writes.py \\
+      --database-url postgresql+psycopg://localhost/eventcloud_bench
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from eventcloud.db import Base  # noqa: E402
+from eventcloud.ingest import MessageWriter  # noqa: E402
+from eventcloud.models import Event  # noqa: E402
+from eventcloud.models import EventMessage  # noqa: E402
+from eventcloud.models import EventMessageImage  # noqa: E402
+
+CODE = "writebench"
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--database-url", default="")
+    p.add_argument("--seed", type=int, default=7)
+    return p.parse_args()
+
+
+def image_keys(rng):
+    if rng.random() >= 0.3:
+        return []
+    return [f"uploads/{rng.getrandbits(64):x}.jpg" for _ in range(rng.randint(1, 3))]
+
+
+def write_old(Session, text, keys):
+    db = Session()
+    message = EventMessage(event_id=CODE, text=text, sender_name="Ana")
+    db.add(message)
+    db.commit()
+    db.refresh(message)
+    for key in keys:
+        db.add(EventMessageImage(image_key=key, event_message_id=message.uuid))
+    db.commit()
+    db.refresh(message)
+    message = db.query(EventMessage).options(selectinload(EventMessage.images)).get(message.uuid)
+    db.close()
+    return message
+
+
+def write_writer(Session, text, keys):
+    return MessageWriter(sessions=Session, batch_ms=0)._commit([(CODE, text, "Ana", keys, None)])[
+        0
+    ]
+
+
+def cleanup(Session):
+    with Session() as db:
+        uuids = db.query(EventMessage.uuid).filter_by(event_id=CODE)
+        db.query(EventMessageImage).filter(
+            EventMessageImage.event_message_id.in_(uuids.scalar_subquery())
+        ).delete(synchronize_session=False)
+        db.query(EventMessage).filter_by(event_id=CODE).delete(synchronize_session=False)
+        db.query(Event).filter_by(code=CODE).delete(synchronize_session=False)
+        db.commit()
+
+
+def main():
+    args = parse_args()
+    url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    statements = [0]
+    event.listen(
+        engine, "before_cursor_execute", lambda *a: statements.__setitem__(0, statements[0] + 1)
+    )
+
+    cleanup(Session)
+    with Session() as db:
+        db.add(Event(code=CODE, title="Write bench"))
+        db.commit()
+
+    print("\n=== message write throughput ===")
+    print(f"database: {engine.dialect.name}, messages: {args.messages}")
+    for label, write in (("old", write_old), ("writer", write_writer)):
+        rng = random.Random(args.seed)
+        statements[0] = 0
+        started = time.perf_counter()
+        for n in range(args.messages):
+            message = write(Session, f"message {n}", image_keys(rng))
+            assert message.text == f"message {n}"
+        elapsed = time.perf_counter() - started
+        print(
+            f"{label:7} {args.messages / elapsed:8.0f} messages/s, "
+            f"{statements[0] / args.messages:4.1f} statements per message"
+        )
+    cleanup(Session)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+publish cost vs subscriber count: per-subscriber queues vs one ring per channel
+
+- "queues": every subscriber owns an asyncio.Queue and each publish puts the
+  frame into all of them, like the broker did before channel rings
+- "ring": the broker as it is now, each publish appends one encoded frame to the
+  channel ring and only wakes subscribers that are waiting
+- subscribers are idle readers blocked on get(), like viewers of a quiet wall
+- prints the median time of one publish and the memory each idle subscriber
+  costs (tracemalloc, measured in a separate pass since tracing slows everything)
+
+usage:
+  PYTHONPATH=src python tests/x_bench_ring_fanout.py --subscribers 100 1000 10000 --messages 50
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import tracemalloc
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+from eventcloud.event_broker import EventBroker  # noqa: E402
+from eventcloud.event_broker import format_frame  # noqa: E402
+
+FRAME = {"html": format_frame("<div>" + "x" * 1000 + "</div>", 1)}
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--subscribers", type=int, nargs="+", default=[100, 1000, 10000])
+    p.add_argument("--messages", type=int, default=50)
+    return p.parse_args()
+
+
+async def read_forever(q):
+    while True:
+        await q.get()
+
+
+async def run_queues(subscribers, messages, trace):
+    if trace:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queues = [asyncio.Queue(maxsize=messages + 10) for _ in range(subscribers)]
+    readers = [asyncio.create_task(read_forever(q)) for q in queues]
+    await asyncio.sleep(0)
+
+    timings = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        frame = FRAME["html"]
+        for q in queues:
+            q.put_nowait(frame)
+        timings.append(time.perf_counter() - started)
+        await asyncio.sleep(0)
+    used = tracemalloc.get_traced_memory()[0] - before
+    if trace:
+        tracemalloc.stop()
+    for reader in readers:
+        reader.cancel()
+    return timings, used
+
+
+async def run_ring(subscribers, messages, trace):
+    if trace:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    broker = EventBroker(queue_size=messages + 10)
+    queues = [await broker.connect("bench") for _ in range(subscribers)]
+    readers = [asyncio.create_task(read_forever(q)) for q in queues]
+    await asyncio.sleep(0)
+
+    timings = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        broker._deliver("bench", FRAME)
+        timings.append(time.perf_counter() - started)
+        await asyncio.sleep(0)
+    used = tracemalloc.get_traced_memory()[0] - before
+    if trace:
+        tracemalloc.stop()
+    for reader in readers:
+        reader.cancel()
+    await broker.stop()
+    return timings, used
+
+
+async def main():
+    args = parse_args()
+    print("\n=== publish cost vs subscribers ===")
+    print(f"messages: {args.messages}, frame: {len(FRAME['html'])} B")
+    for subscribers in args.subscribers:
+        for label, run in (("queues", run_queues), ("ring", run_ring)):
+            timings, _ = await run(subscribers, args.messages, trace=False)
+            _, used = await run(subscribers, args.messages, trace=True)
+            print(
+                f"subscribers: {subscribers:>6} {label:7} "
+                f"publish median: {statistics.median(timings) * 1000:8.3f}ms, "
+                f"memory per subscriber: {used / subscribers:8.0f} B"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
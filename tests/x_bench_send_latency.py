@@ -0,0 +1,90 @@
+"""
+send latency vs audience size: inline publish vs background dispatch
+
+- connects n subscribers to one event on an in-memory EventBroker
+- "inline": the route awaits broker.publish, like send_message used to
+- "dispatch": the route calls broker.dispatch and returns, the dispatcher task
+  publishes in the background
+- prints the median/p99 time the route spends handing off a message, and for
+  dispatch the queue-to-delivery latency the broker recorded
+
+usage:
+  PYTHONPATH=src python tests/x_bench_send_latency.py --viewers 100 1000 5000 --messages 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+from eventcloud.event_broker import EventBroker  # noqa: E402
+
+PAYLOAD = {"html": "<div>" + "x" * 1000 + "</div>", "json": '{"text": "x"}'}
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--viewers", type=int, nargs="+", default=[100, 1000, 5000])
+    p.add_argument("--messages", type=int, default=200)
+    return p.parse_args()
+
+
+async def drain(queues):
+    # Readers keep up so the slow consumer policy stays out of the measurement
+    while True:
+        await asyncio.sleep(0.001)
+        for q in queues:
+            while not q.empty():
+                q.get_nowait()
+
+
+async def run(viewers, messages, inline):
+    broker = EventBroker(queue_size=messages + 10)
+    queues = [await broker.connect("bench") for _ in range(viewers)]
+    reader = asyncio.create_task(drain(queues))
+    handoff = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        if inline:
+            await broker.publish("bench", PAYLOAD)
+        else:
+            broker.dispatch("bench", PAYLOAD)
+        handoff.append(time.perf_counter() - started)
+        await asyncio.sleep(0)  # other requests get the loop between posts
+    await broker.stop()
+    reader.cancel()
+    return handoff, broker.dispatch_seconds
+
+
+def ms(seconds):
+    return f"{seconds * 1000:8.3f}ms"
+
+
+async def main():
+    args = parse_args()
+    print("\n=== send latency vs audience ===")
+    print(f"messages: {args.messages}")
+    for viewers in args.viewers:
+        for label, inline in (("inline publish", True), ("dispatch", False)):
+            handoff, dispatched = await run(viewers, args.messages, inline)
+            p99 = statistics.quantiles(handoff, n=100)[98]
+            line = (
+                f"viewers: {viewers:>5} {label:15} "
+                f"route median: {ms(statistics.median(handoff))}, p99: {ms(p99)}"
+            )
+            if not inline:
+                line += f", queue-to-delivery avg: {ms(dispatched.sum / dispatched.count)}"
+            print(line)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+"""
+stream bandwidth comparison: sse (html and compact json) vs websocket with permessage-deflate
+
+- renders a realistic mix of messages through _messages.html like send_message does
+- sse: bytes of each frame as published on /events/{code}/stream (no compression,
+  event streams are not gzipped by the app or by render's proxy)
+- sse (json): the same frame for streams opened with ?format=json
+- ws: the oob-wrapped payload sent on /events/{code}/ws, raw and compressed the way
+  permessage-deflate does it (raw deflate, sync flush, trailing 00 00 ff ff dropped),
+  with and without context takeover
+- prints total and per-message bytes for every transport
+
+usage:
+  PYTHONPATH=src python tests/x_bench_ws_bandwidth.py --messages 200
+"""
+
+import argparse
+from datetime import datetime
+from datetime import timezone
+import os
+import random
+import zlib
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "bench")
+os.environ.setdefault("HOST", "http://bench")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+
+from starlette.requests import Request  # noqa: E402
+
+from eventcloud.event_broker import format_frame  # noqa: E402
+from eventcloud.models import EventMessage  # noqa: E402
+from eventcloud.models import EventMessageImage  # noqa: E402
+from eventcloud.schemas import EventMessageStreamRecord  # noqa: E402
+from eventcloud.utils import jinja  # noqa: E402
+
+WORDS = (
+    "great talk thanks congrats so proud of you all happy birthday see you at the after "
+    "party best event ever loved the keynote where are the slides cheers from the back row"
+).split()
+NAMES = ["Ana", "Ben", "Carla", "Diego", "Eli", "Fatima", "Gus", "Hana", "Ivan", "June"]
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--seed", type=int, default=7)
+    return p.parse_args()
+
+
+def poster_request(code):
+    return Request(
+        {
+            "type": "http",
+            "method": "POST",
+            "path": f"/message/{code}/",
+            "headers": [(b"hx-current-url", f"http://bench/events/{code}/".encode())],
+            "session": {},
+            "query_string": b"",
+        }
+    )
+
+
+def fake_message(rng, code):
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 40)))
+    message = EventMessage(
+        uuid=str(rng.getrandbits(128)),
+        event_id=code,
+        text=text,
+        sender_name=rng.choice(NAMES),
+        created_at=datetime.now(timezone.utc),
+        pinned=False,
+    )
+    if rng.random() < 0.3:
+        message.images = [
+            EventMessageImage(image_key=f"uploads/{rng.getrandbits(64):x}.jpg")
+            for _ in range(rng.randint(1, 3))
+        ]
+    return message
+
+
+def deflate_message(compressor, data):
+    out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return out[:-4]  # permessage-deflate drops the 00 00 ff ff tail
+
+
+def ws_frame_size(payload_len):
+    # server to client frames are unmasked
+    header = 2 if payload_len < 126 else 4 if payload_len < 65536 else 10
+    return header + payload_len
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    request = poster_request("bench")
+
+    totals = {
+        "sse": 0,
+        "sse (json)": 0,
+        "ws": 0,
+        "ws+deflate": 0,
+        "ws+deflate (no context takeover)": 0,
+    }
+    shared = zlib.compressobj(wbits=-15)
+    for n in range(args.messages):
+        message = fake_message(rng, "bench")
+        html = jinja(request, "_messages.html", {"messages": [message]}).body.decode()
+        payload = '<span data-autoscroll="1" style="display:none"></span>' + html
+
+        frame = format_frame(payload, 1_700_000_000_000_000 + n)
+        totals["sse"] += len(frame.encode())
+        record = EventMessageStreamRecord.from_message(message).model_dump_json()
+        totals["sse (json)"] += len(format_frame(record, 1_700_000_000_000_000 + n).encode())
+
+        ws_text = f'<div id="messages" hx-swap-oob="afterbegin">{payload}</div>'.encode()
+        totals["ws"] += ws_frame_size(len(ws_text))
+        totals["ws+deflate"] += ws_frame_size(len(deflate_message(shared, ws_text)))
+        single = deflate_message(zlib.compressobj(wbits=-15), ws_text)
+        totals["ws+deflate (no context takeover)"] += ws_frame_size(len(single))
+
+    print("\n=== stream bandwidth per transport ===")
+    print(f"messages: {args.messages}")
+    for label, total in totals.items():
+        ratio = totals["sse"] / total
+        print(
+            f"{label:34} total: {total:>9} B, per message: {total / args.messages:>7.0f} B, "
+            f"{ratio:4.1f}x smaller than sse"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+stream lifecycle soak: open and kill thousands of sse connections, check nothing leaks
+
+- serves eventcloud.app with uvicorn inside this process, so the broker can be
+  inspected directly
+- every round opens --connections streams with raw sockets and kills each one at a
+  random point: before the response, right after the headers, or mid-stream
+  while frames are being published; killed sockets are aborted, not closed
+- after each round waits for the server to settle, including the broker's
+  heartbeat, presence and lag monitor loops winding down, and prints RSS, open
+  channels, subscribers and asyncio task count
+- fails (exit code 1) unless subscribers and channels are back to 0, the task
+  count is exactly back to the baseline and RSS stopped growing after the
+  warm-up round
+
+usage:
+  PYTHONPATH=src python tests/x_soak_streams.py --rounds 10 --connections 2000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+os.environ.setdefault("SESSION_SECRET", "soak")
+os.environ.setdefault("HOST", "http://soak")
+os.environ.setdefault("CLOUDFLARE_R2_ACCESS_KEY_ID", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_SECRET_ACCESS_KEY", "dummy")
+os.environ.setdefault("CLOUDFLARE_R2_BUCKET_NAME", "dummy-bucket")
+os.environ.setdefault("CLOUDFLARE_S3_URL", "http://localhost")
+os.environ.setdefault("STREAM_SHED_LAG_MS", "0")  # measure leaks, not load shedding
+
+import uvicorn  # noqa: E402
+
+from eventcloud.app import app  # noqa: E402
+from eventcloud.event_broker import broker  # noqa: E402
+
+PAGE_SIZE = resource.getpagesize()
+REQUEST = "GET /events/{code}/stream HTTP/1.1\r\nHost: soak\r\nAccept: text/event-stream\r\n\r\n"
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--rounds", type=int, default=10)
+    p.add_argument("--connections", type=int, default=2000)
+    p.add_argument("--events", type=int, default=20, help="event codes to spread streams over")
+    p.add_argument("--port", type=int, default=8765)
+    # The heartbeat only notices the last stream is gone after its next tick
+    p.add_argument("--settle", type=float, default=30.0, help="max seconds to wait per round")
+    p.add_argument("--rss-slack-mb", type=float, default=20.0)
+    return p.parse_args()
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 1024 / 1024
+
+
+def state():
+    return {
+        "rss_mb": rss_mb(),
+        "channels": len(broker.channels),
+        "subscribers": broker.subscriber_count,
+        "tasks": len(asyncio.all_tasks()),
+        "loops": len(loops_running()),
+    }
+
+
+async def open_and_kill(port, code, rng):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(REQUEST.format(code=code).encode())
+    await writer.drain()
+    when = rng.choice(("before_response", "after_headers", "mid_stream"))
+    try:
+        if when != "before_response":
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        if when == "mid_stream":
+            await asyncio.wait_for(reader.read(rng.randint(1, 4096)), 5)
+            await asyncio.sleep(rng.random() * 0.5)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.transport.abort()  # vanish without a FIN, like a phone losing signal
+
+
+async def publish_while(codes, running):
+    n = 0
+    while running.is_set():
+        await broker.publish(random.choice(codes), f"<p>soak {n}</p>" + "x" * 500)
+        n += 1
+        await asyncio.sleep(0.005)
+
+
+def loops_running():
+    """The broker's own background loops, which stop once the last stream is gone"""
+    loops = (broker._heartbeat, broker._presence_task, broker.lag_monitor._task)
+    return [task for task in loops if task is not None and not task.done()]
+
+
+async def settle(timeout):
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if broker.subscriber_count == 0 and not broker.channels and not loops_running():
+            break
+        await asyncio.sleep(0.2)
+    # Let per-connection tasks finish unwinding
+    await asyncio.sleep(1)
+
+
+async def main():
+    args = parse_args()
+    server = uvicorn.Server(
+        uvicorn.Config(app, port=args.port, log_level="warning", lifespan="on", backlog=4096)
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    rng = random.Random(7)
+    codes = [f"soak{n}" for n in range(args.events)]
+    baseline = state()
+    history = []
+    print("\n=== stream lifecycle soak ===")
+    print(f"rounds: {args.rounds}, connections per round: {args.connections}")
+    print(f"baseline: {baseline}")
+    for round_no in range(1, args.rounds + 1):
+        running = asyncio.Event()
+        running.set()
+        publisher = asyncio.create_task(publish_while(codes, running))
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(open_and_kill(args.port, rng.choice(codes), rng) for _ in range(args.connections)),
+            return_exceptions=True,
+        )
+        running.clear()
+        await publisher
+        failed = sum(isinstance(r, Exception) for r in results)
+        await settle(args.settle)
+        now = state()
+        history.append(now)
+        print(
+            f"round {round_no:>3}: {time.perf_counter() - started:6.1f}s, "
+            f"client errors: {failed:>4}, rss: {now['rss_mb']:7.1f} MB, "
+            f"channels: {now['channels']}, subscribers: {now['subscribers']}, "
+            f"tasks: {now['tasks']}, broker loops: {now['loops']}"
+        )
+
+    server.should_exit = True
+    await serving
+
+    final = history[-1]
+    warmed_up = history[0]["rss_mb"]
+    problems = []
+    if final["subscribers"] or final["channels"]:
+        problems.append("subscribers or channels were left behind")
+    if final["loops"]:
+        problems.append(f"{final['loops']} broker loops kept running without streams")
+    if final["tasks"] != baseline["tasks"]:
+        problems.append(f"task count went from {baseline['tasks']} to {final['tasks']}")
+    if final["rss_mb"] > warmed_up + args.rss_slack_mb:
+        problems.append(f"rss grew {final['rss_mb'] - warmed_up:.1f} MB after the first round")
+    swept = broker.orphans_swept.value
+    print(f"orphans swept: {swept}, rejected: {broker.rejected_connections}")
+    if problems:
+        print("FAILED: " + "; ".join(problems))
+        sys.exit(1)
+    print("OK: back to baseline")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())